@@ -1,5 +1,17 @@
 import argparse
-from twittp.model import TrendModel
+import asyncio
+import itertools
+import json
+import sys
+import tempfile
+from twittp.benchmark import benchmark
+from twittp.dtw import FastDTW
+from twittp.model import TREND_PREEMT, TrendModel
+from twittp.shards import read_lines
+from twittp.stream import TrendPredictor, file_lines, predict_stream, \
+    socket_lines, stdin_lines
+from twittp.twitter import TOKENIZERS, Stopwords, TweetTable, \
+    compare_tokenizers
 
 
 def main():
@@ -14,7 +26,8 @@ def main():
     build_model_parser.description = 'Build a model for other actions in twittp'
 
     build_model_parser.add_argument('tweets', help='The JSON file containing '
-                                    'tweets from the Twitter API')
+                                    'tweets from the Twitter API, or a store '
+                                    'made by convert-tweets')
     build_model_parser.add_argument('trends', help='The JSON file containing '
                                     'trends from the Twitter API')
     build_model_parser.add_argument('--stopword', help='An optional CSV file '
@@ -22,13 +35,239 @@ def main():
                                     'constructing the model')
     build_model_parser.add_argument('--trend-preempt', help='The number of'
                                     'windows to preempt a trend by', default=0)
+    build_model_parser.add_argument('--bag-capacity', help='The most words '
+                                    'to count when choosing negative trend '
+                                    'names, all of them by default',
+                                    type=int)
     build_model_parser.set_defaults(func=TrendModel.model_from_files)
 
+    convert_parser = subparsers.add_parser('convert-tweets', help='Convert '
+                                           'tweets to a store that builds '
+                                           'models faster')
+
+    convert_parser.description = 'Convert a JSON file of tweets to a ' \
+                                 'columnar store that builds models faster'
+
+    convert_parser.add_argument('tweets', help='The JSON file containing '
+                                'tweets from the Twitter API')
+    convert_parser.add_argument('store', help='The directory to write the '
+                                'store to')
+    convert_parser.add_argument('--jobs', help='The number of processes to '
+                                'convert with', type=int, default=1)
+    convert_parser.add_argument('--tokenizer', help='The tokenizer to find '
+                                'lexical density with', default='nltk',
+                                choices=sorted(TOKENIZERS))
+    convert_parser.set_defaults(func=TweetTable.save)
+
+    convert_model_parser = subparsers.add_parser('convert-model',
+                                                 help='Convert a JSON model '
+                                                 'to a store that loads '
+                                                 'lazily')
+
+    convert_model_parser.description = 'Convert a model serialized as JSON ' \
+                                       'to a memory-mapped store'
+
+    convert_model_parser.add_argument('model', help='The JSON file '
+                                      'containing the model')
+    convert_model_parser.add_argument('store', help='The directory to write '
+                                      'the store to')
+    convert_model_parser.set_defaults(func=TrendModel.convert)
+
+    predict_parser = subparsers.add_parser('predict', help='Predict trends '
+                                           'from a live stream of tweets')
+
+    predict_parser.description = 'Read tweets as they are posted and print ' \
+                                 'the topics whose nearest trend in a model ' \
+                                 'trends, as lines of JSON'
+
+    predict_parser.add_argument('model', help='The model, as JSON or a store '
+                                'made by convert-model')
+    predict_parser.add_argument('source', help='The file of tweets to read, '
+                                '- for standard input, or host:port with '
+                                '--socket')
+    predict_parser.add_argument('--socket', help='Read tweets from a server '
+                                'at source', action='store_true')
+    predict_parser.add_argument('--follow', help='Keep reading tweets added '
+                                'to the file, like tail -f',
+                                action='store_true')
+    predict_parser.add_argument('--names', help='An optional file with one '
+                                'trend name to watch on each line, instead '
+                                'of every word')
+    predict_parser.add_argument('--stopword', help='An optional CSV file '
+                                'containing words that are never candidates')
+    predict_parser.add_argument('--capacity', help='The most candidates to '
+                                'keep at once', type=int, default=1000)
+    predict_parser.add_argument('--history', help='The number of windows of '
+                                'each candidate to match', type=int,
+                                default=TREND_PREEMT)
+    predict_parser.add_argument('--min-windows', help='The number of windows '
+                                'a candidate needs before it is matched',
+                                type=int, default=1)
+    predict_parser.add_argument('--tokenizer', help='The tokenizer to find '
+                                'lexical density with', default='regex',
+                                choices=sorted(TOKENIZERS))
+    predict_parser.add_argument('--candidates', help='The number of trends '
+                                'of the model, nearest by the index, to '
+                                'match each candidate against, or 0 for '
+                                'all of them', type=int, default=50)
+    predict_parser.add_argument('--budget', help='The most candidates to '
+                                'match each time a window closes', type=int,
+                                default=100)
+    predict_parser.add_argument('--jobs', help='The number of processes to '
+                                'match candidates with', type=int, default=1)
+    predict_parser.set_defaults(func=predict_stream)
+
+    approximation_parser = subparsers.add_parser('check-fastdtw',
+                                                 help='Compare FastDTW to '
+                                                 'exact DTW on a model')
+
+    approximation_parser.description = 'Compare the approximate FastDTW ' \
+                                       'distances to the exact DTW ' \
+                                       'distances between a sample of ' \
+                                       'pairs of trends of a model'
+
+    approximation_parser.add_argument('model', help='The model, as JSON or a '
+                                      'store made by convert-model')
+    approximation_parser.add_argument('--radius', help='The FastDTW radius in '
+                                      'time windows', type=int, default=1)
+    approximation_parser.add_argument('--pairs', help='The number of pairs of '
+                                      'trends to compare on', type=int,
+                                      default=1000)
+    approximation_parser.add_argument('--seed', help='The seed to sample '
+                                      'pairs with', type=int)
+    approximation_parser.set_defaults(func=TrendModel.approximation_error)
+
+    recall_parser = subparsers.add_parser('check-index', help='Measure how '
+                                          'often the index keeps the nearest '
+                                          'trend')
+
+    recall_parser.description = 'Measure, for numbers of candidates C, how ' \
+                                'often the nearest trend of every trend of ' \
+                                'a model is among the C candidates its ' \
+                                'index gives it'
+
+    recall_parser.add_argument('model', help='The model, as JSON or a store '
+                               'made by convert-model')
+    recall_parser.add_argument('--counts', help='The numbers of candidates to '
+                               'measure', type=int, nargs='+',
+                               default=[1, 2, 5, 10, 20, 50])
+    recall_parser.add_argument('--jobs', help='The number of processes to '
+                               'search with', type=int, default=-1)
+    recall_parser.set_defaults(func=TrendModel.candidate_recall)
+
+    benchmark_parser = subparsers.add_parser('benchmark', help='Time each '
+                                             'stage of twittp on generated '
+                                             'data')
+
+    benchmark_parser.description = 'Generate tweets and trends with a seed ' \
+                                   'and time each stage of building and ' \
+                                   'testing a model on them, writing the ' \
+                                   'times, throughput and peak memory as JSON'
+
+    benchmark_parser.add_argument('output', help='The JSON file to write the '
+                                  'results to, or - for standard output')
+    benchmark_parser.add_argument('--data', help='The directory to generate '
+                                  'the data in and keep it, a temporary one '
+                                  'by default')
+    benchmark_parser.add_argument('--tweets', help='The number of tweets to '
+                                  'generate', type=int, default=100000)
+    benchmark_parser.add_argument('--topics', help='The number of trending '
+                                  'topics to generate', type=int, default=20)
+    benchmark_parser.add_argument('--hours', help='The hours the tweets are '
+                                  'spread over', type=int, default=24)
+    benchmark_parser.add_argument('--seed', help='The seed to generate data '
+                                  'with', type=int, default=0)
+    benchmark_parser.add_argument('--pairs', help='The number of pairs of '
+                                  'trends to time dtw_distance on', type=int,
+                                  default=1000)
+    benchmark_parser.add_argument('--repeat', help='The number of times to '
+                                  'time each stage, keeping the fastest',
+                                  type=int, default=1)
+    benchmark_parser.add_argument('--jobs', help='The number of processes '
+                                  'stages may use', type=int, default=1)
+    benchmark_parser.add_argument('--tokenizer', help='The tokenizer to find '
+                                  'lexical density with', default='nltk',
+                                  choices=sorted(TOKENIZERS))
+    benchmark_parser.set_defaults(func=benchmark)
+
+    tokenizer_parser = subparsers.add_parser('check-tokenizer', help='Compare '
+                                             'the regex tokenizer to NLTK')
+
+    tokenizer_parser.description = 'Compare the tokens of the regex ' \
+                                   'tokenizer to those of NLTK on a sample ' \
+                                   'of tweets'
+
+    tokenizer_parser.add_argument('tweets', help='The JSON file containing '
+                                  'tweets from the Twitter API')
+    tokenizer_parser.add_argument('--sample', help='The number of tweets to '
+                                  'compare on', type=int, default=10000)
+    tokenizer_parser.set_defaults(func=compare_tokenizers)
+
     args = command_parser.parse_args()
     if args.func == TrendModel.model_from_files:
         model = TrendModel.model_from_files(args.tweets, args.trends,
-                                           args.stopwords)
+                                           args.stopwords,
+                                           bag_capacity=args.bag_capacity)
         print(model.serialize_model())
+    elif args.func == TweetTable.save:
+        TweetTable.from_file(args.tweets, args.jobs, tokenize=True,
+                             tokenizer=args.tokenizer, directory=args.store)
+    elif args.func == TrendModel.convert:
+        TrendModel.convert(args.model, args.store)
+    elif args.func == predict_stream:
+        names = None
+        if args.names is not None:
+            with open(args.names, encoding='utf-8') as f:
+                names = [line.strip() for line in f if line.strip()]
+        stopwords = Stopwords() if args.stopword is None else \
+            Stopwords.from_csv(args.stopword)
+        predictor = TrendPredictor(TrendModel.from_file(args.model), names,
+                                   stopwords, args.capacity, args.history,
+                                   args.min_windows, tokenizer=args.tokenizer,
+                                   candidates=args.candidates or None,
+                                   budget=args.budget, n_jobs=args.jobs)
+        if args.socket:
+            host, port = args.source.rsplit(':', 1)
+            lines = socket_lines(host, int(port))
+        elif args.source == '-':
+            lines = stdin_lines()
+        else:
+            lines = file_lines(args.source, args.follow)
+        asyncio.run(predict_stream(predictor, lines))
+        print('{} windows, slowest took {:.3f}s, {} late tweets'.format(
+            predictor.closed, predictor.slowest, predictor.late),
+            file=sys.stderr)
+    elif args.func == TrendModel.approximation_error:
+        model = TrendModel.from_file(args.model)
+        mean, worst, same, speedup = model.approximation_error(
+            FastDTW(args.radius), args.pairs, args.seed)
+        print('FastDTW with radius {}: {:.1%} of distances exact, off by '
+              '{:.2%} on average and {:.2%} at most, {:.1f}x faster'.format(
+                  args.radius, same, mean, worst, speedup))
+    elif args.func == TrendModel.candidate_recall:
+        model = TrendModel.from_file(args.model)
+        for count, recall in model.candidate_recall(args.counts,
+                                                    n_jobs=args.jobs):
+            print('C = {}: nearest trend among the candidates of {:.1%} of '
+                  'trends, {:.1%} of the trends searched'.format(
+                      count, recall, min(count / max(len(model.trends) - 1, 1),
+                                         1.0)))
+    elif args.func == benchmark:
+        with tempfile.TemporaryDirectory() as directory:
+            results = benchmark(args.data or directory, args.tweets,
+                                args.topics, args.hours, args.seed, args.jobs,
+                                args.pairs, args.repeat, args.tokenizer)
+        if args.output == '-':
+            print(json.dumps(results, indent=2))
+        else:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2)
+    elif args.func == compare_tokenizers:
+        texts = [json.loads(line)['text'] for line in
+                 itertools.islice(read_lines(args.tweets), args.sample)]
+        same, mean, worst = compare_tokenizers(texts)
+        print('{:.1%} of tweets tokenized the same, lexical density off by '
+              '{:.4f} on average and {:.4f} at most'.format(same, mean, worst))
 
 
 if __name__ == '__main__':
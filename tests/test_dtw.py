@@ -0,0 +1,44 @@
+import numpy as np
+from twittp.dtw import OnlineDTW, dtw, pair_cost
+from twittp.model import TrendCell, TrendLine
+
+
+def reference_dtw(a, b):
+    """ The DTW recurrence cell by cell, with TrendCell.distance. """
+    cost = np.full((len(a) + 1, len(b) + 1), np.inf)
+    cost[0, 0] = 0.0
+    for i, cell_a in enumerate(a, 1):
+        for j, cell_b in enumerate(b, 1):
+            cost[i, j] = cell_a.distance(cell_b) + \
+                min(cost[i - 1, j - 1], cost[i - 1, j], cost[i, j - 1])
+    return cost[-1, -1]
+
+
+def random_trend(rng, length):
+    return TrendLine.from_arrays('t', 0, rng.random((length, 8)) * 1000,
+                                 np.zeros(length, dtype=bool))
+
+
+def test_pair_cost_matches_trend_cell_distance():
+    rng = np.random.default_rng(0)
+    a = random_trend(rng, 20000)
+    b = random_trend(rng, 20000)
+    rows = np.arange(20000)
+    costs = pair_cost(a.features(), b.features(), rows, rows,
+                      TrendCell.weights())
+    assert costs.tolist() == [cell_a.distance(cell_b) for cell_a, cell_b in
+                              zip(a.data, b.data)]
+
+
+def test_dtw_matches_trend_cell_recurrence():
+    rng = np.random.default_rng(1)
+    weights = TrendCell.weights()
+    for _ in range(200):
+        a = random_trend(rng, int(rng.integers(1, 12)))
+        b = random_trend(rng, int(rng.integers(1, 12)))
+        expected = reference_dtw(a.data, b.data)
+        assert dtw(a.features(), b.features(), weights) == expected
+        online = OnlineDTW(b.features()[np.newaxis], [len(b.data)], weights)
+        for cell in a.features():
+            distance = online.extend(cell)[0]
+        assert distance == expected
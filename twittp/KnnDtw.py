@@ -1,179 +1,215 @@
 # Taken from http://nbviewer.ipython.org/github/markdregan/K-Nearest-Neighbors-with-Dynamic-Time-Warping/blob/master/K_Nearest_Neighbor_Dynamic_Time_Warping.ipynb
-import sys
-import collections
-import itertools
-from scipy.stats import mode
+from joblib import Parallel, delayed, effective_n_jobs
+import numpy as np
+from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.utils.validation import check_is_fitted
+from .dtw import SakoeChiba, dtw
 
-class KnnDtw(object):
+
+class KnnDtw(BaseEstimator, ClassifierMixin):
     """K-nearest neighbor classifier using dynamic time warping
     as the distance measure between pairs of time series arrays
-    
+
+    The time series are given as a padded tensor of shape
+    [n_samples, n_timepoints, n_features], as TrendModel.tensor is, with NaN
+    past the end of each series. A 2-D array is taken to be one feature.
+    The DTW is multivariate, with the weighted euclidean distance between
+    time points of twittp.dtw as the local cost. This follows the
+    scikit-learn estimator interface, so it can be used with
+    cross_val_score, GridSearchCV and the like.
+
     Arguments
     ---------
     n_neighbors : int, optional (default = 5)
         Number of neighbors to use by default for KNN
-        
-    max_warping_window : int, optional (default = infinity)
+
+    max_warping_window : int or window, optional (default = None)
         Maximum warping window allowed by the DTW dynamic
-        programming function
-            
+        programming function. An int is the radius of a SakoeChiba
+        band, and a SakoeChiba or Itakura constraint is used as is.
+        None leaves the warping unconstrained.
+
     subsample_step : int, optional (default = 1)
         Step size for the timeseries array. By setting subsample_step = 2,
         the timeseries length will be reduced by 50% because every second
         item is skipped. Implemented by x[:, ::subsample_step]
+
+    weights : str, optional (default = 'distance')
+        How the neighbors vote. With 'uniform' every neighbor has one
+        vote, and with 'distance' a vote of the inverse of its distance.
+        Neighbors at distance zero then take all of the votes.
+
+    feature_weights : array of shape [n_features], optional
+        The weight of each feature in the local cost, one for every
+        feature by default
+
+    n_jobs : int, optional (default = -1)
+        The number of joblib workers to compute distances with, all
+        cores by default
     """
-    
-    def __init__(self, n_neighbors=5, max_warping_window=10000, subsample_step=1):
+
+    def __init__(self, n_neighbors=5, max_warping_window=None,
+                 subsample_step=1, weights='distance', feature_weights=None,
+                 n_jobs=-1):
         self.n_neighbors = n_neighbors
         self.max_warping_window = max_warping_window
         self.subsample_step = subsample_step
-    
+        self.weights = weights
+        self.feature_weights = feature_weights
+        self.n_jobs = n_jobs
+
     def fit(self, x, l):
         """Fit the model using x as training data and l as class labels
-        
+
         Arguments
         ---------
-        x : array of shape [n_samples, n_timepoints]
+        x : array of shape [n_samples, n_timepoints, n_features]
             Training data set for input into KNN classifer
-            
+
         l : array of shape [n_samples]
             Training labels for input into KNN classifier
         """
-        
-        self.x = x
-        self.l = l
-        
-    def _dtw_distance(self, ts_a, ts_b, d = lambda x,y: abs(x-y)):
-        """Returns the DTW similarity distance between two 2-D
-        timeseries numpy arrays.
+        self.x_, self.lengths_ = self._series(x)
+        self.classes_, self.l_ = np.unique(np.asarray(l), return_inverse=True)
+        self.n_features_in_ = self.x_.shape[2]
+        return self
+
+    def _series(self, x):
+        """Returns the subsampled tensor of x and the length of each series"""
+        x = np.asarray(x, dtype=np.float64)
+        if x.ndim == 2:
+            x = x[:, :, np.newaxis]
+        x = x[:, ::self.subsample_step]
+        lengths = (~np.isnan(x).any(axis=2)).sum(axis=1)
+        return x, lengths
+
+    def _window(self):
+        """Returns the DTW constraint of max_warping_window"""
+        if isinstance(self.max_warping_window, (int, np.integer)):
+            return SakoeChiba(int(self.max_warping_window))
+        return self.max_warping_window
+
+    def _dist_matrix(self, x=None):
+        """Computes the M x N distance matrix between the testing
+        dataset (x) and the training dataset using the DTW distance
+        measure
+
+        Rows of queries are handed to n_jobs joblib workers. Without
+        x, the matrix is that of the training dataset with itself, and
+        without a warping window only its upper triangle is computed.
 
         Arguments
         ---------
-        ts_a, ts_b : array of shape [n_samples, n_timepoints]
-            Two arrays containing n_samples of timeseries data
-            whose DTW distance between each sample of A and B
-            will be compared
-        
-        d : DistanceMetric object (default = abs(x-y))
-            the distance measure used for A_i - B_j in the
-            DTW dynamic programming function
-        
+        x : array of shape [n_samples, n_timepoints, n_features]
+
+        Returns
+        -------
+        Distance matrix between each item of x and the training data
+            with shape [testing_n_samples, training_n_samples]
+        """
+        window = self._window()
+        weights = np.ones(self.n_features_in_) \
+            if self.feature_weights is None else self.feature_weights
+        if x is None:
+            queries, query_lengths = self.x_, self.lengths_
+        else:
+            queries, query_lengths = self._series(x)
+        symmetric = x is None and window is None
+        chunks = np.array_split(np.arange(len(queries)),
+                                4 * effective_n_jobs(self.n_jobs))
+        rows = Parallel(n_jobs=self.n_jobs)(delayed(dist_rows)(
+            chunk[0], chunk[-1] + 1, queries, query_lengths, self.x_,
+            self.lengths_, weights, window, symmetric)
+            for chunk in chunks if len(chunk) > 0)
+        if len(rows) == 0:
+            return np.zeros((0, len(self.x_)))
+        dm = np.concatenate(rows)
+        if symmetric:
+            upper = np.triu_indices(len(dm), 1)
+            dm.T[upper] = dm[upper]
+        return dm
+
+    def kneighbors(self, x=None, n_neighbors=None, return_distance=True):
+        """Finds the nearest neighbors of each item of x
+
+        Without x, the neighbors of the training data are found, each
+        not being its own neighbor. Neighbors at equal distances are
+        taken in the order of the training data.
+
         Returns
         -------
-        DTW distance between A and B
+        The distances to the neighbors, if return_distance, and their
+        indices, both of shape [testing_n_samples, n_neighbors]
         """
+        check_is_fitted(self)
+        n_neighbors = self.n_neighbors if n_neighbors is None else n_neighbors
+        dm = self._dist_matrix(x)
+        if x is None:
+            np.fill_diagonal(dm, np.inf)
+        knn_idx = np.argsort(dm, axis=1, kind='stable')[:, :n_neighbors]
+        if not return_distance:
+            return knn_idx
+        return np.take_along_axis(dm, knn_idx, axis=1), knn_idx
+
+    def predict_proba(self, x):
+        """Estimates the probability of each class for the provided data
 
-        # Create cost matrix via broadcasting with large int
-        ts_a, ts_b = np.array(ts_a), np.array(ts_b)
-        M, N = len(ts_a), len(ts_b)
-        cost = sys.maxint * np.ones((M, N))
-
-        # Initialize the first row and column
-        cost[0, 0] = d(ts_a[0], ts_b[0])
-        for i in xrange(1, M):
-            cost[i, 0] = cost[i-1, 0] + d(ts_a[i], ts_b[0])
-
-        for j in xrange(1, N):
-            cost[0, j] = cost[0, j-1] + d(ts_a[0], ts_b[j])
-
-        # Populate rest of cost matrix within window
-        for i in xrange(1, M):
-            for j in xrange(max(1, i - self.max_warping_window),
-                            min(N, i + self.max_warping_window)):
-                choices = cost[i - 1, j - 1], cost[i, j-1], cost[i-1, j]
-                cost[i, j] = min(choices) + d(ts_a[i], ts_b[j])
-
-        # Return DTW distance given window 
-        return cost[-1, -1]
-    
-    def _dist_matrix(self, x, y):
-        """Computes the M x N distance matrix between the training
-        dataset and testing dataset (y) using the DTW distance measure
-        
         Arguments
         ---------
-        x : array of shape [n_samples, n_timepoints]
-        
-        y : array of shape [n_samples, n_timepoints]
-        
+          x : array of shape [n_samples, n_timepoints, n_features]
+              Array containing the testing data set to be classified
+
         Returns
         -------
-        Distance matrix between each item of x and y with
-            shape [training_n_samples, testing_n_samples]
+          The share of the votes of the neighbors that went to each
+          class, with shape [n_samples, n_classes] and the classes in
+          the order of classes_
         """
-        
-        # Compute the distance matrix        
-        dm_count = 0
-        
-        # Compute condensed distance matrix (upper triangle) of pairwise dtw distances
-        # when x and y are the same array
-        if(np.array_equal(x, y)):
-            x_s = shape(x)
-            dm = np.zeros((x_s[0] * (x_s[0] - 1)) // 2, dtype=np.double)
-            
-            p = ProgressBar(shape(dm)[0])
-            
-            for i in xrange(0, x_s[0] - 1):
-                for j in xrange(i + 1, x_s[0]):
-                    dm[dm_count] = self._dtw_distance(x[i, ::self.subsample_step],
-                                                      y[j, ::self.subsample_step])
-                    
-                    dm_count += 1
-                    p.animate(dm_count)
-            
-            # Convert to squareform
-            dm = squareform(dm)
-            return dm
-        
-        # Compute full distance matrix of dtw distnces between x and y
+        knn_dist, knn_idx = self.kneighbors(x)
+        if self.weights == 'uniform':
+            votes = np.ones_like(knn_dist)
+        elif self.weights == 'distance':
+            with np.errstate(divide='ignore'):
+                votes = 1 / knn_dist
+            exact = np.isinf(votes)
+            exact_rows = exact.any(axis=1)
+            votes[exact_rows] = exact[exact_rows]
         else:
-            x_s = np.shape(x)
-            y_s = np.shape(y)
-            dm = np.zeros((x_s[0], y_s[0])) 
-            dm_size = x_s[0]*y_s[0]
-            
-            p = ProgressBar(dm_size)
-        
-            for i in xrange(0, x_s[0]):
-                for j in xrange(0, y_s[0]):
-                    dm[i, j] = self._dtw_distance(x[i, ::self.subsample_step],
-                                                  y[j, ::self.subsample_step])
-                    # Update progress bar
-                    dm_count += 1
-                    p.animate(dm_count)
-        
-            return dm
-        
+            raise ValueError("weights must be 'uniform' or 'distance', not "
+                             "{!r}".format(self.weights))
+        proba = np.zeros((len(knn_idx), len(self.classes_)))
+        rows = np.repeat(np.arange(len(knn_idx)), knn_idx.shape[1])
+        np.add.at(proba, (rows, self.l_[knn_idx].ravel()), votes.ravel())
+        return proba / proba.sum(axis=1, keepdims=True)
+
     def predict(self, x):
-        """Predict the class labels or probability estimates for 
-        the provided data
+        """Predict the class labels for the provided data
 
         Arguments
         ---------
-          x : array of shape [n_samples, n_timepoints]
+          x : array of shape [n_samples, n_timepoints, n_features]
               Array containing the testing data set to be classified
-          
+
         Returns
         -------
-          2 arrays representing:
-              (1) the predicted class labels 
-              (2) the knn label count probability
+          The predicted class labels, the class with the most votes,
+          the first in classes_ on ties
         """
-        
-        dm = self._dist_matrix(x, self.x)
-
-        # Identify the k nearest neighbors
-        knn_idx = dm.argsort()[:, :self.n_neighbors]
+        return self.classes_[self.predict_proba(x).argmax(axis=1)]
 
-        # Identify k nearest labels
-        knn_labels = self.l[knn_idx]
-        
-        # Model Label
-        mode_data = mode(knn_labels, axis=1)
-        mode_label = mode_data[0]
-        mode_proba = mode_data[1]/self.n_neighbors
 
-        return mode_label.ravel(), mode_proba.ravel()
+def dist_rows(start, stop, queries, query_lengths, tensor, lengths, weights,
+              window=None, symmetric=False):
+    """Computes rows start to stop of a KnnDtw distance matrix
 
-    def __str__(self):
-        return str(self.prog_bar)
\ No newline at end of file
+    The queries and the training data are given as padded tensors and
+    lengths. With symmetric, the queries are the training data and
+    only the distances above the diagonal are computed.
+    """
+    dm = np.zeros((stop - start, len(tensor)))
+    for i in range(start, stop):
+        query = queries[i, :query_lengths[i]]
+        for j in range(i + 1 if symmetric else 0, len(tensor)):
+            dm[i - start, j] = dtw(query, tensor[j, :lengths[j]], weights,
+                                   window)
+    return dm
@@ -0,0 +1,246 @@
+import gc
+import json
+import os
+import platform
+import random
+import time
+import tracemalloc
+import numpy as np
+from .model import MINIMUM_TREND_SIZE, TREND_PREEMT, TrendCell, TrendLine, \
+    TrendModel, dtw_distance
+from .twitter import BagOfWords, Stopwords, TwitterTrend
+
+BENCHMARK_VERSION = 1  # Bump when the data generated or the stages change
+START = 1400000000 - 1400000000 % 120  # The first window of generated data
+DAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+          'Oct', 'Nov', 'Dec')
+
+
+def created_at(ts):
+    """ Formats a timestamp as the Twitter API does, whatever the locale. """
+    t = time.gmtime(ts)
+    return '{} {} {:02d} {:02d}:{:02d}:{:02d} +0000 {}'.format(
+        DAYS[t.tm_wday], MONTHS[t.tm_mon - 1], t.tm_mday, t.tm_hour, t.tm_min,
+        t.tm_sec, t.tm_year)
+
+
+def generate(directory, tweets=100000, topics=20, hours=24, vocabulary=5000,
+             seed=0):
+    """ Writes a synthetic data set of tweets and trends to a directory.
+
+    tweets.json holds one tweet per line, sorted by time, with the fields
+    bin/clean-raw.py keeps. trends.json holds one response of the trends
+    endpoint for every window, and stopwords.csv the most common words.
+    Every topic trends for one run of windows, long enough to make a
+    positive trend, and is tweeted about more and more over the
+    TREND_PREEMT windows before the run. The other words of the tweets are
+    drawn from a Zipf distribution over a made-up vocabulary. The same
+    arguments give the same files.
+
+    :return: The paths of the tweet, trend and stopword files
+    """
+    rng = np.random.default_rng(seed)
+    windows = hours * 3600 // 120
+    shortest = MINIMUM_TREND_SIZE + 1
+    if windows < TREND_PREEMT + shortest:
+        raise ValueError('{} hours are too short for a trend to fit'.format(
+            hours))
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+    words = [''.join(rng.choice(letters, rng.integers(2, 10)))
+             for _ in range(vocabulary)]
+    names = ['#' + ''.join(rng.choice(letters, rng.integers(4, 12)))
+             for _ in range(topics)]
+    lengths = rng.integers(shortest, min(2 * shortest,
+                                         windows - TREND_PREEMT) + 1,
+                           topics)
+    starts = rng.integers(TREND_PREEMT, windows - lengths + 1)
+
+    # How much each topic is tweeted about in each window
+    window = np.arange(windows)
+    ramp = (window - (starts - TREND_PREEMT)[:, np.newaxis]) / \
+        TREND_PREEMT
+    trending = (window >= starts[:, np.newaxis]) & \
+        (window < (starts + lengths)[:, np.newaxis])
+    interest = np.where(trending, 10.0, 1.0 + 9.0 * np.clip(ramp, 0, 1))
+    interest[window >= (starts + lengths)[:, np.newaxis]] = 1.0
+
+    os.makedirs(directory, exist_ok=True)
+    trend_file = os.path.join(directory, 'trends.json')
+    with open(trend_file, 'w', encoding='utf-8') as f:
+        for w in range(windows):
+            ts = START + w * 120 + 60
+            f.write(json.dumps({
+                'as_of': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                       time.gmtime(ts)),
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                            time.gmtime(ts - 30)),
+                'locations': [{'name': 'Worldwide', 'woeid': 1}],
+                'trends': [{'name': names[k], 'query': names[k],
+                            'url': None, 'promoted_content': None}
+                           for k in np.flatnonzero(trending[:, w])]},
+                ensure_ascii=False) + '\n')
+
+    timestamps = np.sort(rng.integers(START, START + windows * 120, tweets))
+    tweet_windows = (timestamps - START) // 120
+    counts = rng.integers(3, 16, tweets)
+    ranks = np.arange(1, vocabulary + 1)
+    zipf = 1 / ranks ** 1.1
+    drawn = rng.choice(vocabulary, counts.sum(), p=zipf / zipf.sum())
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    # Three tweets in ten mention a topic, picked by interest in the window
+    mentions = rng.random(tweets) < 0.3
+    cumulative = np.cumsum(interest, axis=0)
+    picks = rng.random(tweets) * cumulative[-1, tweet_windows]
+    topic = (picks > cumulative[:, tweet_windows]).sum(axis=0)
+    followers = rng.lognormal(6, 2, tweets).astype(np.int64)
+    statuses = rng.lognormal(8, 1.5, tweets).astype(np.int64)
+    retweeted = rng.random(tweets) < 0.2
+    users = rng.integers(1, max(tweets // 10, 2), tweets)
+
+    tweet_file = os.path.join(directory, 'tweets.json')
+    with open(tweet_file, 'w', encoding='utf-8') as f:
+        for i in range(tweets):
+            text = [words[k] for k in drawn[offsets[i]:offsets[i + 1]]]
+            if mentions[i]:
+                text.insert(int(drawn[offsets[i]] % len(text)),
+                            names[topic[i]])
+            f.write(json.dumps({
+                'text': ' '.join(text),
+                'created_at': created_at(int(timestamps[i])), 'id': i,
+                'user_id': int(users[i]),
+                'user_followers': int(followers[i]),
+                'user_statuses': int(statuses[i]), 'source': 'web',
+                'lang': 'en', 'retweeted': bool(retweeted[i])},
+                ensure_ascii=False) + '\n')
+
+    stopword_file = os.path.join(directory, 'stopwords.csv')
+    with open(stopword_file, 'w', encoding='utf-8') as f:
+        f.write(','.join(words[:20]) + '\n')
+    return tweet_file, trend_file, stopword_file
+
+
+def measure(run, setup=None, repeat=1):
+    """ Times a stage and traces the memory it allocates.
+
+    The stage is run repeat times and the fastest kept, then once more under
+    tracemalloc for the peak of the memory allocated by Python and NumPy
+    during it. Memory of joblib workers and of memory-mapped files is not
+    traced. If setup is given, what it returns is passed to every run, and
+    it is not timed.
+
+    :return: The seconds, the peak bytes and what the last timed run returned
+    """
+    seconds = []
+    result = None
+    for _ in range(repeat):
+        argument = () if setup is None else (setup(),)
+        gc.collect()
+        started = time.perf_counter()
+        result = run(*argument)
+        seconds.append(time.perf_counter() - started)
+    argument = () if setup is None else (setup(),)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run(*argument)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return min(seconds), peak, result
+
+
+def positive_trends(twitter_trends):
+    """ Makes the positive trends of a model, as new_model_from_files does.
+
+    Unlike those of model_from_files, these are labelled as trending, so
+    that leave_one_out has positives to find.
+    """
+    positives = [trend for trend in
+                 TrendLine.from_twitter_trends(twitter_trends)
+                 if len(trend.data) >= MINIMUM_TREND_SIZE]
+    for trend in positives:
+        trend.data = [TrendCell(True) for _ in range(TREND_PREEMT)]
+        trend.start_ts -= 60 * TREND_PREEMT
+    return positives
+
+
+def copy_trends(trends):
+    """ Copies TrendLines, so that a stage can change them again. """
+    return [TrendLine.from_arrays(trend.name, trend.start_ts,
+                                  trend.features().copy(),
+                                  trend.flags().copy(), trend.window_size)
+            for trend in trends]
+
+
+def benchmark(directory, tweets=100000, topics=20, hours=24, seed=0,
+              n_jobs=1, pairs=1000, repeat=1, tokenizer='nltk'):
+    """ Times every stage of building and testing a model on generated data.
+
+    The data is generated into directory (see generate), and each stage is
+    timed on its own (see measure), with its inputs made beforehand the way
+    new_model_from_files makes them. The throughput of a stage is the number
+    of items it handles per second: the lines of trends.json, the tweets, the
+    time windows of the model, the pairs of trends or the trends.
+
+    :return: An object with the settings, the machine and the stages, to be
+             written as JSON
+    """
+    tweet_file, trend_file, stopword_file = generate(
+        directory, tweets, topics, hours, seed=seed)
+    with open(trend_file, encoding='utf-8') as f:
+        snapshots = sum(1 for _ in f)
+    stages = []
+
+    def stage(name, items, unit, run, setup=None):
+        seconds, peak, result = measure(run, setup, repeat)
+        stages.append({'stage': name, 'seconds': seconds, 'items': items,
+                       'unit': unit,
+                       'throughput': items / seconds if seconds > 0 else None,
+                       'peak_bytes': peak})
+        return result
+
+    twitter_trends = stage('TwitterTrend.from_file', snapshots, 'snapshots',
+                           lambda: TwitterTrend.from_file(trend_file))
+    stopwords = Stopwords.from_csv(stopword_file)
+    bag_of_words = stage('BagOfWords.from_file', tweets, 'tweets',
+                         lambda: BagOfWords.from_file(tweet_file, stopwords,
+                                                      n_jobs))
+    random.seed(seed)
+    trends = positive_trends(twitter_trends)
+    trends.extend(TrendLine.construct_negative_trends(trends, bag_of_words))
+
+    def populate(copies):
+        TrendLine.populate_from_file(copies, tweet_file, n_jobs, tokenizer)
+        return copies
+
+    trends = stage('TrendLine.populate_from_file', tweets, 'tweets',
+                   populate, lambda: copy_trends(trends))
+    windows = sum(len(trend.data) for trend in trends)
+
+    def normalize(unnormalized):
+        unnormalized.normalize()
+        return unnormalized
+
+    trend_model = stage('TrendModel.normalize', windows, 'windows',
+                        normalize, lambda: TrendModel(copy_trends(trends)))
+    rng = random.Random(seed)
+    sample = [rng.sample(trend_model.trends, 2) for _ in range(pairs)]
+    stage('dtw_distance', pairs, 'pairs',
+          lambda: [dtw_distance(a, b) for a, b in sample])
+    stage('TrendModel.leave_one_out', len(trend_model.trends), 'trends',
+          lambda: trend_model.leave_one_out(n_jobs=n_jobs))
+
+    return {'version': BENCHMARK_VERSION,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'machine': {'node': platform.node(),
+                        'processor': platform.processor(),
+                        'cpus': os.cpu_count(),
+                        'python': platform.python_version(),
+                        'numpy': np.__version__},
+            'settings': {'tweets': tweets, 'topics': topics, 'hours': hours,
+                         'seed': seed, 'n_jobs': n_jobs, 'pairs': pairs,
+                         'repeat': repeat, 'tokenizer': tokenizer,
+                         'trends': len(trend_model.trends),
+                         'windows': windows},
+            'stages': stages}
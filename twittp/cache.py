@@ -0,0 +1,162 @@
+import hashlib
+import os
+import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
+from .dtw import dtw
+from .sliding import sliding_distance
+
+CACHE_VERSION = 1  # Bump when the way distances are computed changes
+
+
+def content_key(queries, query_lengths, references, lengths, weights,
+                window=None, metric='dtw'):
+    """ Hashes everything a matrix of distances depends on.
+
+    This covers the feature data of every query and reference, including
+    their lengths, the weights used for each query and the DTW settings. Any
+    change to the model, to normalization or to the weights gives a new key.
+    Only the windows of each series are hashed, not the padding of the
+    tensors, so the key does not depend on how they are padded.
+    """
+    digest = hashlib.sha256()
+    digest.update('{}:{}:{!r}'.format(CACHE_VERSION, metric,
+                                      window).encode('utf-8'))
+    for tensor, group_lengths in ((queries, query_lengths),
+                                  (references, lengths)):
+        digest.update(np.int64(len(group_lengths)).tobytes())
+        for i, n in enumerate(group_lengths):
+            features = np.ascontiguousarray(tensor[i, :n], dtype=np.float64)
+            digest.update(np.array(features.shape, dtype=np.int64).tobytes())
+            digest.update(features.tobytes())
+    digest.update(np.ascontiguousarray(weights, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def prefix_key(key, length):
+    """ Derives the key of the distances from the first length windows of
+    the queries from the content_key of the whole queries.
+
+    The prefixes depend on nothing but the queries and their length, so
+    the queries only need to be hashed once for all of their prefixes.
+    """
+    return hashlib.sha256('{}:prefix:{}'.format(key, length)
+                          .encode('utf-8')).hexdigest()
+
+
+class DistanceCache:
+    """ A matrix of distances from queries to references kept on disk.
+
+    The matrix is stored as a memory-mapped .npy file in the cache directory,
+    named after the content_key of its inputs. Distances that have not been
+    computed yet are NaN, so a run that is interrupted leaves a partially
+    filled matrix that the next run with the same inputs picks up from.
+    """
+
+    def __init__(self, directory, queries, query_lengths, references,
+                 lengths, weights, window=None, symmetric=False,
+                 metric='dtw', key=None):
+        """ Constructor for DistanceCache, which opens or creates the file.
+
+        The queries and references are given as padded series x time window x
+        feature tensors and their lengths, like the tensor of a TrendModel,
+        and weights is either one weight vector or one per query. If
+        symmetric is True, the queries and the references are the same
+        trends, so the diagonal is zero. Without a window and with the same
+        weights for every query, each distance is then also shared with its
+        transposed entry. The metric is dtw, or one of twittp.sliding, for
+        which the window is not used. The key of the matrix is the
+        content_key of the inputs unless it is given, as by prefix_key.
+        """
+        self.queries = queries
+        self.query_lengths = np.asarray(query_lengths)
+        self.references = references
+        self.lengths = np.asarray(lengths)
+        self.weights = np.broadcast_to(np.asarray(weights, dtype=np.float64),
+                                       (len(self.query_lengths),
+                                        queries.shape[2]))
+        self.window = window
+        self.metric = metric
+        self.symmetric = symmetric and (window is None or metric != 'dtw') \
+            and (self.weights == self.weights[0]).all()
+        self.key = key if key is not None else content_key(
+            queries, self.query_lengths, references, self.lengths,
+            self.weights, window, metric)
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, self.key + '.npy')
+        if os.path.exists(self.path):
+            self.matrix = np.load(self.path, mmap_mode='r+')
+        else:
+            self.matrix = np.lib.format.open_memmap(
+                self.path + '.tmp', mode='w+', dtype=np.float64,
+                shape=(len(self.query_lengths), len(self.lengths)))
+            self.matrix[:] = np.nan
+            if symmetric:
+                np.fill_diagonal(self.matrix, 0.0)
+            self.matrix.flush()
+            os.replace(self.path + '.tmp', self.path)
+            self.matrix = np.load(self.path, mmap_mode='r+')
+
+    def missing(self, rows=None):
+        """ Returns the rows, of those given, with distances still to do. """
+        rows = range(len(self.query_lengths)) if rows is None else rows
+        return [i for i in rows if np.isnan(self.matrix[i]).any()]
+
+    def fill(self, rows=None, n_jobs=-1):
+        """ Computes every missing distance in the rows, all rows by default.
+
+        The missing rows are split into contiguous chunks for n_jobs joblib
+        workers, all cores by default, as in TrendModel.nearest_trends. The
+        workers get the padded tensors, which joblib hands them as memory
+        maps rather than pickling them, and write straight into the
+        memory-mapped file, flushing after each row.
+        """
+        missing = self.missing(rows)
+        if len(missing) == 0:
+            return self.matrix
+        chunks = np.array_split(np.array(missing),
+                                4 * effective_n_jobs(n_jobs))
+        Parallel(n_jobs=n_jobs)(delayed(fill_rows)(
+            self.path, chunk, self.queries, self.query_lengths,
+            self.references, self.lengths, self.weights[chunk], self.window,
+            self.symmetric, self.metric)
+            for chunk in chunks if len(chunk) > 0)
+        self.matrix = np.load(self.path, mmap_mode='r+')
+        return self.matrix
+
+    def write(self, i, row):
+        """ Stores row i of the matrix, computed elsewhere. """
+        self.matrix[i] = row
+        self.matrix.flush()
+
+    def row(self, i):
+        """ Returns row i of the matrix, computing it first if needed. """
+        if np.isnan(self.matrix[i]).any():
+            fill_rows(self.path, [i], self.queries, self.query_lengths,
+                      self.references, self.lengths, self.weights[[i]],
+                      self.window, self.symmetric, self.metric)
+        return self.matrix[i]
+
+
+def fill_rows(path, rows, queries, query_lengths, references, lengths,
+              weights, window, symmetric, metric='dtw'):
+    """ Computes the missing distances of some rows of a cached matrix.
+
+    Weights holds the weight vector of each of the rows.
+    """
+    matrix = np.load(path, mmap_mode='r+')
+    for i, row_weights in zip(rows, weights):
+        query = queries[i, :query_lengths[i]]
+        row = np.array(matrix[i])
+        for j in np.flatnonzero(np.isnan(row)):
+            reference = references[j, :lengths[j]]
+            if symmetric and not np.isnan(matrix[j, i]):
+                row[j] = matrix[j, i]
+            elif metric == 'dtw':
+                row[j] = dtw(query, reference, row_weights, window)
+            else:
+                row[j] = sliding_distance(query, reference, row_weights,
+                                          metric)
+        matrix[i] = row
+        if symmetric:
+            matrix[:, i] = row
+        matrix.flush()
@@ -0,0 +1,93 @@
+import struct
+import numpy as np
+
+HEADER_SIZE = 128  # Bytes reserved for the header of a ColumnWriter file
+
+
+class ColumnWriter:
+    """ Writes a one-dimensional .npy file a chunk of values at a time.
+
+    The length of the column is not known until it is closed, so room is
+    left for the header at the start of the file and the header is written
+    last. Only the chunk being written is ever held in memory. With packed,
+    the column is booleans kept as a bitmap, as np.packbits gives it, and
+    fewer than 8 of them are held back between writes.
+    """
+
+    def __init__(self, path, dtype, packed=False):
+        """ Constructor for ColumnWriter, which creates the file. """
+        self.file = open(path, 'wb')
+        self.file.write(bytes(HEADER_SIZE))
+        self.dtype = np.dtype(np.uint8 if packed else dtype)
+        self.packed = packed
+        self.pending = np.zeros(0, dtype=bool)
+        self.size = 0
+
+    def write(self, values):
+        """ Appends values, anything np.asarray takes, to the column. """
+        if self.packed:
+            values = np.concatenate((self.pending,
+                                     np.asarray(values, dtype=bool)))
+            whole = len(values) - len(values) % 8
+            self.pending = values[whole:]
+            values = np.packbits(values[:whole])
+        values = np.asarray(values, dtype=self.dtype)
+        self.file.write(values.tobytes())
+        self.size += len(values)
+
+    def close(self):
+        """ Writes the header, and any bits held back, and closes the file. """
+        if self.packed and len(self.pending) > 0:
+            values = np.packbits(self.pending)
+            self.file.write(values.tobytes())
+            self.size += len(values)
+        header = repr({'descr': np.lib.format.dtype_to_descr(self.dtype),
+                       'fortran_order': False, 'shape': (self.size,)})
+        preamble = np.lib.format.magic(1, 0)
+        length = HEADER_SIZE - len(preamble) - 2
+        self.file.seek(0)
+        self.file.write(preamble + struct.pack('<H', length) +
+                        header.ljust(length - 1).encode('latin1') + b'\n')
+        self.file.close()
+
+
+class Bitmap:
+    """ A column of booleans kept as a bitmap, as np.packbits gives it.
+
+    Indexing reads only the bytes of the bits asked for, so a bitmap that
+    is memory-mapped is read from disk as it is used rather than unpacked
+    as a whole.
+    """
+
+    def __init__(self, bits, size):
+        """ Constructor for Bitmap from the packed bits and their number. """
+        self.bits = bits
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.size)
+            if step != 1:
+                return np.asarray(self)[index]
+            stop = max(start, stop)
+            first = start // 8
+            bits = np.unpackbits(self.bits[first:(stop + 7) // 8])
+            return bits[start - 8 * first:stop - 8 * first].astype(bool)
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError('Bitmap index out of range')
+        return bool(self.bits[index >> 3] >> (7 - (index & 7)) & 1)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.unpackbits(self.bits, count=self.size).astype(
+            bool if dtype is None else dtype)
+
+
+def chunks_of(column, size):
+    """ Yields consecutive slices of at most size values of a column. """
+    for start in range(0, len(column), size):
+        yield column[start:start + size]
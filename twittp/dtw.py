@@ -0,0 +1,395 @@
+import numpy as np
+from scipy.ndimage import maximum_filter1d, minimum_filter1d
+
+
+class SakoeChiba:
+    """ A Sakoe-Chiba band around the diagonal of the DTW matrix.
+
+    Row i of an n x m matrix may only be warped onto the columns within radius
+    of its position on the line from (0, 0) to (n - 1, m - 1). For trend lines
+    of equal length this is the classic |i - j| <= radius band.
+    """
+
+    def __init__(self, radius):
+        """ Constructor for SakoeChiba with the radius in time windows. """
+        self.radius = radius
+
+    def bounds(self, n, m):
+        """ Returns the first and last column allowed in each row. """
+        center = self.centers(n, m)
+        return center - self.radius, center + self.radius
+
+    @staticmethod
+    def centers(n, m):
+        """ Returns the column of the diagonal in each row, rounded. """
+        if n == 1:
+            return np.zeros(1, dtype=np.int64)
+        return (np.arange(n) * (m - 1) + (n - 1) // 2) // (n - 1)
+
+    def __repr__(self):
+        return 'SakoeChiba(radius={})'.format(self.radius)
+
+
+class Itakura:
+    """ An Itakura parallelogram constraint on the DTW matrix.
+
+    Warping paths may neither rise nor run faster than max_slope, measured
+    from both the start and the end of the matrix, which gives a parallelogram
+    with corners at (0, 0) and (n - 1, m - 1).
+    """
+
+    def __init__(self, max_slope=2.0):
+        """ Constructor for Itakura with the largest slope allowed. """
+        self.max_slope = max_slope
+
+    def bounds(self, n, m):
+        """ Returns the first and last column allowed in each row. """
+        i = np.arange(n)
+        s = self.max_slope
+        lo = np.maximum(np.ceil(i / s - 1e-9),
+                        np.ceil((m - 1) - s * (n - 1 - i) - 1e-9))
+        hi = np.minimum(np.floor(s * i + 1e-9),
+                        np.floor((m - 1) - (n - 1 - i) / s + 1e-9))
+        return lo.astype(np.int64), hi.astype(np.int64)
+
+    def __repr__(self):
+        return 'Itakura(max_slope={})'.format(self.max_slope)
+
+
+class FastDTW:
+    """ An approximation of DTW by multi-resolution refinement, as FastDTW.
+
+    Both series are coarsened by averaging pairs of time windows until one
+    of them has at most radius + 2 windows, where DTW is solved exactly. The
+    warping path found at each level is projected onto the next finer one
+    and widened by radius windows on every side, and DTW is solved again
+    only inside that window. The cost thus grows about linearly with the
+    length of the series rather than with the product of their lengths. The
+    distance is that of a warping path, so it is never less than the exact
+    DTW distance.
+    """
+
+    def __init__(self, radius=1):
+        """ Constructor for FastDTW with the radius in time windows. """
+        self.radius = radius
+
+    def project(self, a, b, weights):
+        """ Returns the window to solve DTW in for a and b at full length.
+
+        This is None if the series are short enough to be solved exactly.
+        """
+        if min(len(a), len(b)) <= self.radius + 2:
+            return None
+        coarse_a = coarsen(a)
+        coarse_b = coarsen(b)
+        rows, columns = dtw_path(coarse_a, coarse_b, weights,
+                                 self.project(coarse_a, coarse_b, weights))
+        return Projected.from_path(rows, columns, len(a), self.radius)
+
+    def dtw(self, a, b, weights, abandon=None):
+        """ Computes the approximate DTW distance, like dtw does.
+
+        The window depends on the weights, so with a K x feature matrix of
+        weights each of the K distances is approximated on its own.
+        """
+        weights = np.asarray(weights)
+        if weights.ndim == 2:
+            limits = [None] * len(weights) if abandon is None else abandon
+            return np.array([self.dtw(a, b, row, limit)
+                             for row, limit in zip(weights, limits)])
+        return dtw(a, b, weights, self.project(a, b, weights), abandon)
+
+    def __repr__(self):
+        return 'FastDTW(radius={})'.format(self.radius)
+
+
+class Projected:
+    """ A window with given column bounds in every row.
+
+    This is what FastDTW solves a level in, projected from the warping path
+    of the level above.
+    """
+
+    def __init__(self, lo, hi):
+        """ Constructor for Projected from the bounds of every row. """
+        self.lo = lo
+        self.hi = hi
+
+    def bounds(self, n, m):
+        """ Returns the first and last column allowed in each row. """
+        return self.lo.copy(), self.hi.copy()
+
+    @staticmethod
+    def from_path(rows, columns, n, radius):
+        """ Projects the warping path of two coarsened series onto n rows.
+
+        Every cell of the path is widened by radius cells on all sides, and
+        every coarse cell covers two rows and two columns of the finer
+        level, as coarsen pairs them.
+        """
+        coarse_n = rows[-1] + 1
+        lo = np.full(coarse_n, columns[-1], dtype=np.int64)
+        hi = np.zeros(coarse_n, dtype=np.int64)
+        np.minimum.at(lo, rows, columns)
+        np.maximum.at(hi, rows, columns)
+        size = 2 * radius + 1
+        lo = minimum_filter1d(lo, size, mode='nearest') - radius
+        hi = maximum_filter1d(hi, size, mode='nearest') + radius
+        coarse_row = np.minimum(np.arange(n) // 2, coarse_n - 1)
+        return Projected(2 * lo[coarse_row], 2 * hi[coarse_row] + 1)
+
+
+def coarsen(a):
+    """ Halves a series by averaging each pair of time windows.
+
+    If the series has an odd length, its last window is kept as it is.
+    """
+    half = len(a) // 2
+    coarse = (a[0:2 * half:2] + a[1:2 * half:2]) / 2
+    if len(a) % 2 == 1:
+        coarse = np.concatenate((coarse, a[-1:]))
+    return coarse
+
+
+def band(window, n, m):
+    """ Returns the column range of every row of an n x m DTW matrix.
+
+    A window of None leaves the matrix unconstrained. Otherwise the bounds of
+    the window are widened where necessary so that every row is non-empty,
+    both the first and the last cell are inside the band, and a warping path
+    from one to the other always exists. The latter matters when the lengths
+    of the two series differ by more than an Itakura slope allows.
+    """
+    if window is None:
+        return np.zeros(n, dtype=np.int64), np.full(n, m - 1, dtype=np.int64)
+    lo, hi = window.bounds(n, m)
+    lo = np.clip(lo, 0, m - 1)
+    hi = np.clip(hi, 0, m - 1)
+    lo[0] = 0
+    hi[-1] = m - 1
+    hi = np.maximum.accumulate(hi)
+    lo = np.minimum.accumulate(lo[::-1])[::-1]
+    lo = np.minimum(lo, hi)
+    hi[:-1] = np.maximum(hi[:-1], lo[1:] - 1)
+    return lo, hi
+
+
+def local_cost(a, b, weights):
+    """ Computes the weighted euclidean distance between every pair of cells.
+
+    Both a and b are float64 feature matrices with one row per time window and
+    one column per feature (see FEATURES in twittp.model). The result is the
+    n x m matrix of TrendCell.distance values.
+    """
+    n, m = len(a), len(b)
+    i, j = np.divmod(np.arange(n * m), m)
+    return pair_cost(a, b, i, j, weights).reshape(n, m)
+
+
+def pair_cost(a, b, i, j, weights):
+    """ Computes the weighted euclidean distance between cells a[i] and b[j].
+
+    The features are accumulated one at a time and in order so the result
+    matches TrendCell.distance to the last bit. If weights is a K x feature
+    matrix, the squared differences are computed once and the result has a
+    trailing axis with the distance under each of the K weight vectors.
+    """
+    weights = np.asarray(weights)
+    if weights.ndim == 2:
+        diff = np.atleast_1d(a[i, 0] - b[j, 0])[:, np.newaxis]
+        total = weights[:, 0] * (diff * diff)
+        for f in range(1, a.shape[1]):
+            diff = np.atleast_1d(a[i, f] - b[j, f])[:, np.newaxis]
+            total += weights[:, f] * (diff * diff)
+        return np.sqrt(total)
+    diff = a[i, 0] - b[j, 0]
+    total = weights[0] * (diff * diff)
+    for f in range(1, a.shape[1]):
+        diff = a[i, f] - b[j, f]
+        total += weights[f] * (diff * diff)
+    return np.sqrt(total)
+
+
+def dtw(a, b, weights, window=None, abandon=None):
+    """ Computes the Dynamic-Time Warp distance between two feature matrices.
+
+    The window is None for the full n x m matrix, or a SakoeChiba or Itakura
+    constraint. A FastDTW window gives its approximation instead. Only the
+    local costs of cells inside the band are computed, in one vectorized
+    step, and then the recurrence is evaluated one anti-diagonal at a time,
+    since every cell on an anti-diagonal only depends on the two
+    anti-diagonals before it. If abandon is given, infinity is returned as
+    soon as the distance is known to be greater than it.
+
+    With a K x feature matrix of weights, the DTW for all K weight vectors is
+    computed in one pass over the band and an array of K distances returned.
+    Abandon is then an array too, and the computation is only abandoned once
+    every distance is known to be greater than its abandon value.
+    """
+    if isinstance(window, FastDTW):
+        return window.dtw(a, b, weights, abandon)
+    n, m = len(a), len(b)
+    start, stop, i, j = band_cells(window, n, m)
+    return wavefront(pair_cost(a, b, i, j, weights), start, stop, n, abandon)
+
+
+def band_cells(window, n, m):
+    """ Returns the anti-diagonals of the band and the cells on them.
+
+    The rows [start[k], stop[k]) of every anti-diagonal k are as diagonals
+    gives them, and the rows i and columns j of all cells of the band are
+    listed anti-diagonal by anti-diagonal, as wavefront takes their costs.
+    """
+    lo, hi = band(window, n, m)
+    start, stop = diagonals(lo, hi)
+    sizes = np.maximum(stop - start, 0)
+    offsets = np.cumsum(sizes) - sizes
+    i = np.arange(sizes.sum()) - np.repeat(offsets - start, sizes)
+    j = np.repeat(np.arange(len(sizes)), sizes) - i
+    return start, stop, i, j
+
+
+def dtw_path(a, b, weights, window=None):
+    """ Finds the warping path of the DTW distance between a and b.
+
+    The accumulated cost of every cell of the band is kept (see wavefront),
+    and the path is traced back from the last cell, each time to the
+    cheapest of the cells it could have come from, the diagonal one on
+    ties. Weights is a single weight vector.
+
+    :return: The rows and the columns of the cells of the path, from the
+             first cell to the last
+    """
+    n, m = len(a), len(b)
+    start, stop, i, j = band_cells(window, n, m)
+    accumulated = np.empty(len(i))
+    wavefront(pair_cost(a, b, i, j, weights), start, stop, n,
+              out=accumulated)
+    sizes = np.maximum(stop - start, 0)
+    offsets = (np.cumsum(sizes) - sizes).tolist()
+    start = start.tolist()
+    stop = stop.tolist()
+    accumulated = accumulated.tolist()
+
+    def cost_at(cell):
+        row, column = cell
+        k = row + column
+        if column < 0 or not start[k] <= row < stop[k]:
+            return np.inf
+        return accumulated[offsets[k] + row - start[k]]
+
+    row, column = n - 1, m - 1
+    rows = [row]
+    columns = [column]
+    while row > 0 or column > 0:
+        row, column = min(((row - 1, column - 1), (row - 1, column),
+                           (row, column - 1)), key=cost_at)
+        rows.append(row)
+        columns.append(column)
+    return np.array(rows[::-1]), np.array(columns[::-1])
+
+
+def diagonals(lo, hi):
+    """ Returns the range of rows [start, stop) of each band anti-diagonal.
+
+    Cell (i, j) lies on anti-diagonal i + j. Since both lo + i and hi + i are
+    strictly increasing, the rows of an anti-diagonal that are inside the band
+    are contiguous.
+    """
+    rows = np.arange(len(lo))
+    k = np.arange(len(lo) + hi[-1])
+    return (np.searchsorted(hi + rows, k, side='left'),
+            np.searchsorted(lo + rows, k, side='right'))
+
+
+def wavefront(cost, start, stop, n, abandon=None, out=None):
+    """ Accumulates the band local costs into the DTW distance.
+
+    The costs are laid out anti-diagonal by anti-diagonal, and anti-diagonal k
+    holds rows start[k] to stop[k]. The accumulated cost of the two previous
+    anti-diagonals is kept in buffers indexed by row, with one slot of padding
+    in front so that i - 1 is always a valid index. Cells outside the band
+    hold infinity so they never win the minimum.
+
+    A warping path steps onto the next or the next but one anti-diagonal, so
+    it crosses at least one of any two consecutive anti-diagonals. Since costs
+    are never negative, the smaller of their minimums is a lower bound on the
+    distance, which is what early abandoning compares against.
+
+    If out is given, the accumulated cost of every cell is also written to
+    it, laid out as the costs are.
+    """
+    buffers = [np.full((n + 1,) + cost.shape[1:], np.inf) for _ in range(3)]
+    written = [(0, 0)] * 3
+    buffers[0][1] = cost[0]
+    written[0] = (1, 2)
+    if out is not None:
+        out[0] = cost[0]
+    offset = 1
+    last_min = cost[0]
+    for k in range(1, len(start)):
+        lo, hi = start[k], stop[k]
+        current = buffers[k % 3]
+        prev1 = buffers[(k - 1) % 3]
+        prev2 = buffers[(k - 2) % 3]
+        current[written[k % 3][0]:written[k % 3][1]] = np.inf
+        if lo < hi:
+            best = np.minimum(prev1[lo:hi], prev1[lo + 1:hi + 1])
+            best = np.minimum(best, prev2[lo:hi])
+            current[lo + 1:hi + 1] = cost[offset:offset + hi - lo] + best
+            if out is not None:
+                out[offset:offset + hi - lo] = current[lo + 1:hi + 1]
+            offset += hi - lo
+        written[k % 3] = (lo + 1, hi + 1)
+        if abandon is not None:
+            current_min = current[lo + 1:hi + 1].min(axis=0) if lo < hi \
+                else np.inf
+            if np.all(np.minimum(current_min, last_min) > abandon):
+                return np.inf if cost.ndim == 1 else \
+                    np.full(cost.shape[1], np.inf)
+            last_min = current_min
+    return buffers[(len(start) - 1) % 3][n]
+
+
+class OnlineDTW:
+    """ DTW distances from a growing query to a fixed set of references.
+
+    The query is fed in one time window at a time. For every reference the
+    last row of the accumulated cost matrix is kept, and each new window of
+    the query adds one row, so after j windows the distances are those of the
+    first j windows of the query. Only unconstrained DTW can be extended like
+    this, since the band of a window depends on the length of the query.
+    """
+
+    def __init__(self, tensor, lengths, weights):
+        """ Constructor for OnlineDTW with an empty query.
+
+        The references are given as a reference x time window x feature
+        tensor, padded past the end of each reference, and their lengths.
+        """
+        self.tensor = tensor
+        self.lengths = np.asarray(lengths)
+        self.weights = weights
+        self.inside = np.arange(tensor.shape[1]) < self.lengths[:, np.newaxis]
+        # Column 0 stands for the cell before the first of each reference
+        self.row = np.full((len(tensor), tensor.shape[1] + 1), np.inf)
+        self.row[:, 0] = 0.0
+
+    def extend(self, cell):
+        """ Adds a time window to the query and returns the new distances.
+
+        The result holds the DTW distance from the query so far to every
+        reference, the same as dtw computes to the last bit.
+        """
+        diff = cell[0] - self.tensor[:, :, 0]
+        total = self.weights[0] * (diff * diff)
+        for f in range(1, self.tensor.shape[2]):
+            diff = cell[f] - self.tensor[:, :, f]
+            total += self.weights[f] * (diff * diff)
+        cost = np.where(self.inside, np.sqrt(total), np.inf)
+        best = np.minimum(self.row[:, :-1], self.row[:, 1:])
+        row = np.full_like(self.row, np.inf)
+        for j in range(cost.shape[1]):
+            row[:, j + 1] = cost[:, j] + np.minimum(best[:, j], row[:, j])
+        self.row = row
+        return row[np.arange(len(row)), self.lengths]
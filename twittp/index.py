@@ -0,0 +1,98 @@
+import numpy as np
+from sklearn.neighbors import BallTree
+
+SEGMENTS = 8  # Number of piecewise aggregate segments of a summary
+
+
+def summarize(tensor, lengths, weights, segments=SEGMENTS):
+    """ Maps trends of any length to fixed-length summary vectors.
+
+    The trends are given as a padded trend x time window x feature tensor
+    and their lengths, like the tensor of a TrendModel. A summary holds the
+    mean of every feature over each of segments equal parts of the trend,
+    its piecewise aggregate approximation, and then the mean and standard
+    deviation of every feature over the whole trend. A part of a trend with
+    fewer windows than segments is the window it starts at. Every feature is
+    scaled by the square root of its weight, so that euclidean distances
+    between summaries weigh the features as the local cost of DTW does.
+
+    :return: A trend x (segments + 2) * feature matrix
+    """
+    lengths = np.asarray(lengths)
+    n, width, f = tensor.shape
+    inside = np.arange(width) < lengths[:, np.newaxis]
+    values = np.where(inside[..., np.newaxis], tensor, 0.0)
+    sums = np.zeros((n, width + 1, f))
+    np.cumsum(values, axis=1, out=sums[:, 1:])
+    rows = np.arange(n)[:, np.newaxis]
+    edges = np.arange(segments + 1) * lengths[:, np.newaxis] // segments
+    counts = np.diff(edges, axis=1)[..., np.newaxis]
+    first = values[rows, np.minimum(edges[:, :-1],
+                                    np.maximum(lengths - 1, 0)[:, np.newaxis])]
+    paa = np.where(counts > 0, (sums[rows, edges[:, 1:]] -
+                                sums[rows, edges[:, :-1]]) /
+                   np.maximum(counts, 1), first)
+    count = np.maximum(lengths, 1)[:, np.newaxis]
+    mean = sums[:, -1] / count
+    std = np.sqrt(np.maximum((values * values).sum(axis=1) / count -
+                             mean * mean, 0.0))
+    summary = np.concatenate((paa, mean[:, np.newaxis], std[:, np.newaxis]),
+                             axis=1)
+    summary *= np.sqrt(np.asarray(weights, dtype=np.float64))
+    return summary.reshape(n, -1)
+
+
+class TrendIndex:
+    """ A BallTree over the summaries of the trends of a model.
+
+    Nearest-neighbour searches use it as a prefilter: the trends with the
+    nearest summaries to a query are its candidates, and only those have
+    their DTW distance computed. This is an approximation, since the nearest
+    trend by DTW need not be among them (see TrendModel.candidate_recall).
+    """
+
+    def __init__(self, summaries, weights, segments=SEGMENTS):
+        """ Constructor for TrendIndex from the summaries of the trends.
+
+        The weights and segments are those the summaries were made with,
+        which queries are summarized with too. The tree is only built the
+        first time the index is searched, so an index opened from a model
+        store reads none of its summaries until then.
+        """
+        self.summaries = summaries
+        self.weights = weights
+        self.segments = segments
+        self._tree = None
+
+    @property
+    def tree(self):
+        """ The BallTree over the summaries, built when first needed. """
+        if self._tree is None:
+            self._tree = BallTree(self.summaries)
+        return self._tree
+
+    @staticmethod
+    def build(tensor, lengths, weights, segments=SEGMENTS):
+        """ Summarizes the trends of a padded tensor and indexes them. """
+        return TrendIndex(summarize(tensor, lengths, weights, segments),
+                          weights, segments)
+
+    def candidates(self, tensor, lengths, count, exclude=False, sort=True):
+        """ Finds the count trends with the nearest summaries to each query.
+
+        The queries are given as a padded tensor and lengths too. With
+        exclude, the queries are the indexed trends themselves and query i
+        is never a candidate of its own.
+
+        :return: A query x count matrix of trend indices, each row in
+                 increasing order so that searches break ties as they do
+                 over all trends, or without sort from the nearest summary
+        """
+        k = min(count + exclude, len(self.summaries))
+        _, indices = self.tree.query(
+            summarize(tensor, lengths, self.weights, self.segments), k=k)
+        if exclude:
+            keep = indices != np.arange(len(indices))[:, np.newaxis]
+            keep[keep.all(axis=1), -1] = False
+            indices = indices[keep].reshape(len(indices), k - 1)
+        return np.sort(indices, axis=1) if sort else indices
@@ -0,0 +1,37 @@
+from bisect import bisect_right
+from collections import defaultdict
+
+
+class IntervalIndex:
+    """ Finds which of a set of half-open intervals [start, end) hold a point.
+
+    The endpoints of all intervals split the line into elementary segments,
+    and the intervals that cover each segment are worked out once by a sweep
+    over the endpoints. A lookup is then a bisection over the endpoints, so
+    its cost depends on the number of intervals that hold the point, not on
+    the number of intervals.
+    """
+
+    def __init__(self, starts, ends):
+        """ Constructor for IntervalIndex, where interval i is starts[i] to
+        ends[i].
+        """
+        opening = defaultdict(list)
+        closing = defaultdict(list)
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            opening[start].append(i)
+            closing[end].append(i)
+        self.bounds = sorted(set(opening) | set(closing))
+        self.segments = []
+        active = set()
+        for bound in self.bounds:
+            active.update(opening[bound])
+            active.difference_update(closing[bound])
+            self.segments.append(tuple(sorted(active)))
+
+    def lookup(self, point):
+        """ Returns the indices of the intervals that hold point, in order. """
+        k = bisect_right(self.bounds, point) - 1
+        if k < 0:
+            return ()
+        return self.segments[k]
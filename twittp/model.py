@@ -1,127 +1,295 @@
-from copy import deepcopy
-from datetime import datetime, timedelta, timezone
-from joblib import Parallel, delayed
+from collections.abc import Sequence
+from joblib import Parallel, delayed, effective_n_jobs
 import math
-import nltk
 import numpy as np
+import os
 import random
 import json
-from .twitter import BagOfWords, Stopwords, TwitterTrend
+import time
+from .cache import DistanceCache, content_key, prefix_key
+from .dtw import FastDTW, OnlineDTW, dtw
+from .index import SEGMENTS, TrendIndex
+from .interval import IntervalIndex
+from .search import Envelope, Envelopes, PruneStats, nearest
+from .sliding import sliding_distance, sliding_distances
+from .twitter import NameMatcher, Stopwords, TweetTable, TwitterTrend, \
+    lexical_density
 
 
 TREND_PREEMT = 90  # Number of windows to preempt trends by
 MINIMUM_TREND_SIZE = 90  # Shortest positive trend to allow
+MODEL_VERSION = 1  # Bump when the layout of model stores changes
+
+# The TrendCell features in the order TrendCell.distance accumulates them
+FEATURES = ('count', 'delta', 'delta_delta', 'avg_followers', 'avg_statuses',
+            'retweets', 'lengths', 'lexical_density')
+# The names knockout reports each of the FEATURES under
+KNOCKOUT_NAMES = ('count', 'delta', 'delta_delta', 'followers', 'statuses',
+                  'retweets', 'lengths', 'ld')
+
+
+def dtw_distance(a, b, weights=None, window=None):
+    """ Function to compute the Dynamic-Time Warp Distance between TrendLines.
+
+    This computes the DTW distance according to
+    http://en.wikipedia.org/wiki/Dynamic_time_warping using TrendCell.distance
+    as the local cost. The work is done on float64 feature matrices by
+    twittp.dtw rather than cell by cell. Unless weights are given, the feature
+    weights are those of TrendCell. The window is an optional
+    SakoeChiba or Itakura constraint on the warping path, or FastDTW for its
+    approximation of the distance.
+    """
+    if weights is None:
+        weights = TrendCell.weights()
+    return dtw(a.features(), b.features(), weights, window)
+
+
+def nearest_chunk(start, stop, queries, query_lengths, tensor, lengths,
+                  weights, window=None, envelopes=None, leave_one_out=False,
+                  metric='dtw', candidates=None):
+    """ Finds the nearest trend of each of the queries start to stop.
+
+    The queries and the trends are given as the padded tensors and lengths of
+    TrendModels. These are what is sent to the workers of
+    TrendModel.nearest_trends, and joblib hands large arrays to its workers
+    as memory maps rather than pickling them. With leave_one_out, the
+    queries are the trends, and query i is not matched with trend i. Weights
+    may also be a K x feature matrix (see nearest). With a metric of
+    twittp.sliding rather than dtw, the distances to all trends are computed
+    at once by sliding_distances, and the window and envelopes are not used.
+    Candidates is an optional query x C matrix of the trends each query is
+    matched against instead of all of them (see TrendIndex.candidates),
+    which then never hold the query itself with leave_one_out.
+
+    :return: The indices of the nearest trends, their distances, and the
+             PruneStats of the searches, with one row per query
+    """
+    stats = PruneStats()
+    matches = []
+    distances = []
+    if metric != 'dtw':
+        for i in range(start, stop):
+            if candidates is None:
+                references, reference_lengths = tensor, lengths
+            else:
+                references = tensor[candidates[i]]
+                reference_lengths = lengths[candidates[i]]
+            row = np.array([sliding_distances(queries[i, :query_lengths[i]],
+                                              references, reference_lengths,
+                                              row_weights, metric)
+                            for row_weights in np.atleast_2d(weights)])
+            if leave_one_out and candidates is None:
+                row[:, i] = np.inf
+            match = row.argmin(axis=1)
+            distance = row[np.arange(len(row)), match]
+            if candidates is not None:
+                match = candidates[i][match]
+            matches.append(match if np.ndim(weights) == 2 else match[0])
+            distances.append(distance if np.ndim(weights) == 2
+                             else distance[0])
+        return np.array(matches), np.array(distances), stats
+    references = [tensor[i, :n] for i, n in enumerate(lengths)]
+    for i in range(start, stop):
+        query = queries[i, :query_lengths[i]]
+        if candidates is None:
+            match, distance = nearest(query, references, weights, window,
+                                      envelopes,
+                                      exclude=i if leave_one_out else None,
+                                      stats=stats)
+        else:
+            chosen = candidates[i]
+            match, distance = nearest(
+                query, [references[j] for j in chosen], weights, window,
+                None if envelopes is None else [envelopes[j] for j in chosen],
+                stats=stats)
+            if match is not None:
+                match = chosen[match]
+        matches.append(match)
+        distances.append(distance)
+    return np.array(matches), np.array(distances), stats
+
+
+def outcome_counts(labels, test_labels, matches):
+    """ Counts the nearest-neighbour outcomes from the indices of matches.
+
+    The labels say whether each trend of the model trends, test_labels
+    whether each test trend does, and matches holds the index of the trend
+    each test trend was matched with.
+    """
+    predicted = np.asarray(labels)[matches]
+    actual = np.asarray(test_labels)
+    true_negatives = int(np.count_nonzero(~actual & ~predicted))
+    true_positives = int(np.count_nonzero(actual & predicted))
+    false_negatives = int(np.count_nonzero(actual & ~predicted))
+    false_positives = int(np.count_nonzero(~actual & predicted))
+    return true_negatives, true_positives, false_negatives, false_positives
 
 
-def dtw_distance(a, b):
-    """ Function to compute the Dynamic-Time Warp Distance between arrays.
+def aggregate_tweets(tweets, start, stop, spans, named):
+    """ Totals tweets start to stop of a TweetTable for each trend window.
 
-    This takes two numpy arrays and computes the DTW distance according to
-    http://en.wikipedia.org/wiki/Dynamic_time_warping
+    Spans holds the name, start timestamp, window size and number of windows
+    of each trend. A tweet counts towards a window of a trend if it was
+    posted in the window and matches the name of the trend, as in
+    TrendLine.match_text. Named says which words of the vocabulary of the
+    tweets are in any trend name, and only tweets with one of those words
+    are looked at.
+
+    :return: A map from (trend index, window offset) to WindowTotals
     """
-    n = len(a.data)
-    m = len(b.data)
-
-    dtw = np.zeros((n, m), dtype=np.object)
-    dtw[0][0] = a.data[0].distance(b.data[0])
-
-    for i in range(n):
-        if i == 0:
-            continue
-        dtw[i][0] = a.data[i].distance(b.data[0]) + dtw[i - 1][0]
-
-    for j in range(m):
-        if j == 0:
-            continue
-        dtw[0][j] = a.data[0].distance(b.data[j]) + dtw[0][j - 1]
-
-    for i in range(n):
-        if i == 0:
-            continue
-        for j in range(m):
-            if j == 0:
+    # Index the time ranges of our trends so each tweet is only
+    # checked against the trends that are active when it was posted
+    active = IntervalIndex([start_ts for _, start_ts, _, _ in spans],
+                           [start_ts + window_size * n for _, start_ts,
+                            window_size, n in spans])
+    names = NameMatcher([name for name, _, _, _ in spans])
+    offsets = tweets.word_offsets[start:stop + 1]
+    hits = named[tweets.word_ids[offsets[0]:offsets[-1]]]
+    candidates = start + np.unique(np.repeat(np.arange(stop - start),
+                                             np.diff(offsets))[hits])
+    totals = {}
+    for t in candidates.tolist():
+        ts = int(tweets.epochs[t])
+        matches = names.matches(tweets.words(t))
+        # The tweet is only tokenized once, and only if it matches a trend
+        density = None
+        for i in active.lookup(ts):
+            if i not in matches:
                 continue
+            if density is None:
+                density = lexical_density(tweets.tokens(t))
+            _, start_ts, window_size, _ = spans[i]
+            key = (i, (ts - start_ts) // window_size)
+            if key not in totals:
+                totals[key] = WindowTotals()
+            totals[key].add(tweets, t, density)
+    return totals
 
-            dtw[i][j] = a.data[i].distance(b.data[j]) + min(dtw[i - 1][j], dtw[i][j - 1], dtw[i - 1][j - 1])
-    return dtw[n - 1][m - 1]
-
-
-def trend_compare(i, mat):
-    """ """
-    true_positives = 0
-    true_negatives = 0
-    false_positives = 0
-    false_negatives = 0
-    match = None
-    min_distance = None
-
-    for j, trend_b in enumerate(mat):
-        if i == j:
-            continue
-        dist = dtw_distance(mat[i], trend_b)
-        if match is None:
-            match = j
-            min_distance = dist
-        else:
-            if dist < min_distance:
-                match = j
-                min_distance = dist
-
-    a_trend = mat[i].data[0].trending
-    match_trend = mat[match].data[0].trending
-    print("{}, {}".format(i, match))
-    print(min_distance)
-    if a_trend and match_trend:
-        true_positives += 1
-        print("[{}] True Positive".format(i))
-    elif a_trend and not match_trend:
-        false_negatives += 1
-        print("[{}] False Negative".format(i))
-    elif not a_trend and match_trend:
-        false_positives += 1
-        print("[{}] False Positive".format(i))
-    else:
-        true_negatives += 1
-        print("[{}] True Negative".format(i))
-    return true_negatives, true_positives, false_negatives, false_positives
 
+def pack_trends(trends):
+    """ Moves the data of a list of TrendLines into one padded tensor.
 
-def trend_compare_test(i, mat, test_mat):
-    """ """
-    true_positives = 0
-    true_negatives = 0
-    false_positives = 0
-    false_negatives = 0
-    match = None
-    min_distance = None
-
-    for j, trend_b in enumerate(mat):
-        dist = dtw_distance(test_mat[i], trend_b)
-        if match is None:
-            match = j
-            min_distance = dist
-        else:
-            if dist < min_distance:
-                match = j
-                min_distance = dist
-
-    a_trend = test_mat[i].data[0].trending
-    match_trend = mat[match].data[0].trending
-    print("{}, {}".format(i, match))
-    print(min_distance)
-    if a_trend and match_trend:
-        true_positives += 1
-        print("[{}] True Positive".format(i))
-    elif a_trend and not match_trend:
-        false_negatives += 1
-        print("[{}] False Negative".format(i))
-    elif not a_trend and match_trend:
-        false_positives += 1
-        print("[{}] False Positive".format(i))
-    else:
-        true_negatives += 1
-        print("[{}] True Negative".format(i))
-    return true_negatives, true_positives, false_negatives, false_positives
+    The tensor is trend x time window x feature in FEATURES order, padded
+    with NaN past the end of each trend, and the flags are the matching
+    trend x time window boolean array. Each TrendLine is left backed by its
+    slice of these arrays.
+
+    :return: The tensor, the flags, and the number of windows of each trend
+    """
+    lengths = np.array([len(trend.features()) for trend in trends],
+                       dtype=np.int64)
+    width = lengths.max() if len(trends) > 0 else 0
+    tensor = np.full((len(trends), width, len(FEATURES)), np.nan)
+    flags = np.zeros((len(trends), width), dtype=bool)
+    for i, trend in enumerate(trends):
+        n = lengths[i]
+        tensor[i, :n] = trend.features()
+        flags[i, :n] = trend.flags()
+        trend.attach(tensor[i, :n], flags[i, :n])
+    return tensor, flags, lengths
+
+
+def derive_features(tensor, lengths):
+    """ Turns the window totals of a padded tensor of trends into features.
+
+    Every total but the count is divided by the count of its window where
+    that is not zero. Delta is the change in count since the window before
+    and delta_delta the change in delta, except that both are zero in the
+    first window of a trend and delta_delta in the second as well. The
+    padding past the end of each trend is left as it is.
+    """
+    inside = np.arange(tensor.shape[1]) < lengths[:, np.newaxis]
+    count = tensor[:, :, FEATURES.index('count')]
+    seen = inside & (count > 0)
+    for feature in ('avg_followers', 'avg_statuses', 'retweets', 'lengths',
+                    'lexical_density'):
+        column = tensor[:, :, FEATURES.index(feature)]
+        np.divide(column, count, out=column, where=seen)
+    delta = np.zeros_like(count)
+    delta[:, 1:] = np.diff(count, axis=1)
+    delta_delta = np.zeros_like(count)
+    delta_delta[:, 2:] = np.diff(delta[:, 1:], axis=1)
+    for feature, values in (('delta', delta), ('delta_delta', delta_delta)):
+        column = tensor[:, :, FEATURES.index(feature)]
+        column[inside] = values[inside]
+
+
+def feature_scales(tensor, lengths):
+    """ Returns what TrendModel.normalize divides each trend feature by.
+
+    This is the largest absolute value of the feature in the trend, or one
+    if that is zero or the feature is retweets, as a trend x feature matrix
+    for a padded tensor of trends.
+    """
+    inside = np.arange(tensor.shape[1]) < lengths[:, np.newaxis]
+    scales = np.where(inside[:, :, np.newaxis], np.abs(tensor), 0.0) \
+        .max(axis=1, initial=0.0)
+    scaled = np.array([feature != 'retweets' for feature in FEATURES])
+    scales[(scales == 0) | ~scaled] = 1
+    return scales
+
+
+class WindowTotals:
+    """ The totals of the tweets of one trend window, before averaging.
+
+    The lexical densities of the tweets are kept one by one, so that adding
+    them to a TrendCell sums them in the same order as reading the tweets
+    one at a time would, to the last bit.
+    """
+
+    def __init__(self):
+        """ Constructor for WindowTotals with no tweets. """
+        self.count = 0
+        self.followers = 0
+        self.statuses = 0
+        self.lengths = 0
+        self.retweets = 0
+        self.lexical_densities = []
+
+    def add(self, tweets, t, density):
+        """ Adds tweet t of a TweetTable, with its lexical density. """
+        self.count += 1
+        self.followers += int(tweets.followers[t])
+        self.statuses += int(tweets.statuses[t])
+        self.lengths += int(tweets.lengths[t])
+        self.lexical_densities.append(density)
+        if tweets.retweeted[t]:
+            self.retweets += 1
+
+    def add_to(self, datum):
+        """ Adds the totals to the sums held in a TrendCell. """
+        datum.count += self.count
+        datum.avg_followers += self.followers
+        datum.avg_statuses += self.statuses
+        datum.lengths += self.lengths
+        datum.retweets += self.retweets
+        lexical_density = datum.lexical_density
+        for value in self.lexical_densities:
+            lexical_density += value
+        datum.lexical_density = lexical_density
+
+
+def distance_compare(distances, labels, test_labels, leave_one_out=False):
+    """ Counts the nearest-neighbour outcomes from a matrix of distances.
+
+    Row i of distances holds the distances from test trend i to every trend
+    of the model, and labels and test_labels say whether each trend trends.
+    With leave_one_out, the test trends are the model trends, so a trend is
+    never matched with itself. Ties go to the first trend, as they do in
+    nearest.
+    """
+    distances = np.array(distances)
+    if leave_one_out:
+        np.fill_diagonal(distances, np.inf)
+    return outcome_counts(labels, test_labels, distances.argmin(axis=1))
+
+
+def precision_recall(true_negatives, true_positives, false_negatives,
+                     false_positives):
+    """ Returns the precision and recall of nearest-neighbour outcomes. """
+    precision = true_positives / (true_positives + false_positives)
+    recall = true_positives / (true_positives + false_negatives)
+    return precision, recall
 
 
 def array_trend_distance(a, b):
@@ -130,43 +298,19 @@ def array_trend_distance(a, b):
     This takes two numpy arrays of features like c_t1, d_t1, dd_t1, ..., c_tn,
     d_tn, dd_tn, which should be very sparse, and finds the alignment that
     minimizes euclidean distance and returns the distance of that alignment.
+    Only the span from the first to the last non-zero of each array is
+    aligned, the shorter span at every offset of the longer one, and the
+    distance is zero if either array is all zeros. This is the euclidean
+    metric of twittp.sliding on the spans.
     """
-    if len(a) > len(b):
-        return array_trend_distance(b, a)
-
-    # Since a and b are likely sparse, let's just get the non-zeroes
-    start_a = None
-    end_a = 0
-    start_b = None
-    end_b = 0
-    for x in range(len(a)):
-        if a[x] != 0:
-            end_a = x
-            if start_a is None:
-                start_a = x
-        if b[x] != 0:
-            end_b = x
-            if start_b is None:
-                start_b = x
-    len_a = end_a - start_a + 1
-    len_b = end_b - start_b + 1
-
-    if start_a is None or start_b is None:
+    nonzero_a = np.flatnonzero(a)
+    nonzero_b = np.flatnonzero(b)
+    if len(nonzero_a) == 0 or len(nonzero_b) == 0:
         return 0
-
-    min_distance = None
-
-    for offset in range(len_b - len_a + 1):
-        total = 0
-        for i in range(len(a)):
-            total += math.sqrt(a[start_a + i] - b[start_b + offset + i])
-
-        if min_distance is None:
-            min_distance = total
-        elif min_distance > total:
-            min_distance = total
-
-    return min_distance
+    span_a = np.asarray(a, dtype=np.float64)[nonzero_a[0]:nonzero_a[-1] + 1]
+    span_b = np.asarray(b, dtype=np.float64)[nonzero_b[0]:nonzero_b[-1] + 1]
+    return sliding_distance(span_a[:, np.newaxis], span_b[:, np.newaxis],
+                            np.ones(1), metric='euclidean')
 
 
 class TrendModel:
@@ -177,155 +321,376 @@ class TrendModel:
 
         A TrendModel can be loosely reasoned about as a list of different
         TrendLines, some positive, some negative. The constructor reflects
-        this.
+        this. The data of the trends is moved into the model (see pack).
         """
         self.trends = trends
+        self.weights = TrendCell.weights()
+        self._envelopes = {}
+        self.tensor = None
+        self.flags = None
+        self.lengths = None
+        self.scales = None
+        self.index = None
+        if trends is not None:
+            self.pack()
+
+    def pack(self):
+        """ Moves the data of all trends into one padded tensor.
+
+        The tensor is trend x time window x feature in FEATURES order, padded
+        with NaN past the end of each trend, and lengths holds the number of
+        windows of each trend. Flags is the matching trend x time window
+        boolean array of TrendCell.trending. Each TrendLine is left backed by
+        its slice of these arrays, so changes made through the TrendLines or
+        their TrendCells show in the tensor and vice versa. Call this again
+        after replacing the data of a trend.
+        """
+        self.tensor, self.flags, self.lengths = pack_trends(self.trends)
+        self._envelopes = {}
+        self.index = None
 
-    def leave_one_out_test(self, test):
-        """ Computes the leave-one-out precision and recall of the model.
+    def envelopes(self, window=None):
+        """ Returns the LB_Keogh envelopes of the trends for a DTW window.
 
-        In the future, this may tune TopicCell weights until this is optimum.
-        For now, it just computes it.
+        These are computed from the tensor the first time they are needed for
+        a window radius and kept with the model afterwards, as padded arrays
+        that joblib hands to the workers of nearest_trends as memory maps
+        (see Envelopes).
         """
-        true_positives = 0
-        true_negatives = 0
-        false_positives = 0
-        false_negatives = 0
+        radius = Envelope.radius_for(window)
+        if radius not in self._envelopes:
+            self._envelopes[radius] = Envelopes(self.tensor, self.lengths,
+                                                radius)
+        return self._envelopes[radius]
 
-        mat = [trend for trend in self.trends]
-        test_mat = [trend for trend in test.trends]
+    def build_index(self, segments=SEGMENTS):
+        """ Builds the TrendIndex of the trends, with the model weights.
 
-        parallel_results = Parallel(n_jobs=4)(delayed(trend_compare_test)(i, mat, test_mat) for i in range(len(test_mat)))
+        The index is kept with the model, and written to its store by save,
+        until the data of the trends changes (see pack and normalize).
+        """
+        self.index = TrendIndex.build(self.tensor, self.lengths,
+                                      self.weights, segments)
+        return self.index
 
-        for p_true_negatives, p_true_positives, p_false_negatives, p_false_positives in parallel_results:
-            true_positives += p_true_positives
-            true_negatives += p_true_negatives
-            false_negatives += p_false_negatives
-            false_positives += p_false_positives
+    def labels(self):
+        """ Returns whether each trend trends, going by its first cell.
 
-        precision = true_positives / (true_positives + false_positives)
-        recall = true_positives / (true_positives + false_negatives)
+        This reads the flags of the model, so no TrendLines are created.
+        """
+        return np.array(self.flags[:, 0], dtype=bool)
 
-        return precision, recall
+    def distances(self, cache_dir, test=None, window=None, weights=None,
+                  metric='dtw'):
+        """ Returns the DistanceCache from the test trends to these trends.
 
-    def flawed_test(self):
+        Without a test model, the matrix is that of the model with itself, as
+        used by leave_one_out. The matrix is empty until it is filled. The
+        weights default to those of the model.
         """
-
-        :return:
+        weights = self.weights if weights is None else weights
+        if test is None:
+            return DistanceCache(cache_dir, self.tensor, self.lengths,
+                                 self.tensor, self.lengths, weights, window,
+                                 symmetric=True, metric=metric)
+        return DistanceCache(cache_dir, test.tensor, test.lengths,
+                             self.tensor, self.lengths, weights, window,
+                             metric=metric)
+
+    def nearest_trends(self, test=None, window=None, weights=None,
+                       stats=None, n_jobs=-1, metric='dtw', candidates=None):
+        """ Finds the nearest trend of the model to every test trend.
+
+        Without a test model, every trend of the model is matched with the
+        nearest other trend, as in leave_one_out. The test trends are split
+        into contiguous chunks for n_jobs joblib workers, all cores by
+        default, which get the padded tensors of the models rather than the
+        TrendLines (see nearest_chunk). The pruning counts of the searches
+        are added to stats if it is given. The metric is dtw, or sliding or
+        euclidean for the alignments without warping of twittp.sliding. With
+        a number of candidates C, every test trend is only matched against
+        the C trends the index of the model gives it (see TrendIndex), which
+        is built first if the model has none.
+
+        :return: The arrays of the indices of the nearest trends and of their
+                 distances, with one row per test trend
         """
+        weights = self.weights if weights is None else weights
+        queries = self if test is None else test
+        if candidates is not None:
+            index = self.build_index() if self.index is None else self.index
+            candidates = index.candidates(queries.tensor, queries.lengths,
+                                          candidates, exclude=test is None)
+        chunks = np.array_split(np.arange(len(queries.trends)),
+                                4 * effective_n_jobs(n_jobs))
+        results = Parallel(n_jobs=n_jobs)(delayed(nearest_chunk)(
+            chunk[0], chunk[-1] + 1, queries.tensor, queries.lengths,
+            self.tensor, self.lengths, weights, window,
+            self.envelopes(window) if metric == 'dtw' else None, test is None,
+            metric, candidates)
+            for chunk in chunks if len(chunk) > 0)
+        if len(results) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        if stats is not None:
+            for _, _, chunk_stats in results:
+                stats.add(chunk_stats)
+        return np.concatenate([matches for matches, _, _ in results]), \
+            np.concatenate([distances for _, distances, _ in results])
+
+    def leave_one_out_test(self, test, window=None, stats=None,
+                           cache_dir=None, weights=None, n_jobs=-1,
+                           metric='dtw', candidates=None):
+        """ Computes the precision and recall of the model on a test model.
+
+        Every trend of the test model is matched with the nearest trend of
+        this one. The window is an optional SakoeChiba or Itakura constraint
+        for the DTW distance, or FastDTW to approximate it. The pruning
+        counts of the nearest-neighbour searches are added to stats if it is
+        given. With a cache_dir, the full matrix of distances is computed or
+        read from there instead (see distances). The weights default to those
+        of the model, and n_jobs is the number of workers, all cores by
+        default. The metric and the number of candidates are those of
+        nearest_trends, and the cached matrix always has every distance.
+        """
+        if cache_dir is not None:
+            distances = self.distances(cache_dir, test, window, weights,
+                                       metric).fill(n_jobs=n_jobs)
+            return precision_recall(*distance_compare(
+                distances, self.labels(), test.labels()))
+        matches, _ = self.nearest_trends(test, window, weights, stats, n_jobs,
+                                         metric, candidates)
+        return precision_recall(*outcome_counts(self.labels(), test.labels(),
+                                                matches))
+
+    def flawed_test(self, window=None, cache_dir=None):
+        """ Computes how early each trending trend is matched to a trend.
+
+        The first j windows of every trending trend, for j from 1 to 90, are
+        matched against the other trends, and the lead time of the trend is
+        90 - 2j minutes for the first j whose match trends. Without a window,
+        the DTW distances of every prefix are computed in one forward pass
+        over the trend (see OnlineDTW). With one, each prefix is matched by
+        its own nearest-neighbour search. With a cache_dir, the distances of
+        every prefix are kept there instead (see cached_flawed_test).
+
+        :return: The lead times of the trends that are matched in time
+        """
+        if cache_dir is not None:
+            return self.cached_flawed_test(cache_dir, window)
         results = []
-        model_copy = deepcopy(self)
-        for i, trend in enumerate(model_copy.trends):
-            if not trend.data[0].trending:
+        labels = self.labels()
+        for i, trend in enumerate(self.trends):
+            if not labels[i]:
                 continue
-            original = list(trend.data)
+            features = trend.features()
+            online = OnlineDTW(self.tensor, self.lengths, self.weights) \
+                if window is None else None
             for j in range(1, 91):
-                trend.data = original[:j]
-                if self.match(trend, i):
+                if online is None:
+                    matched = self.match(features[:j], i, window)
+                else:
+                    if j <= len(features):
+                        distances = online.extend(features[j - 1])
+                        distances[i] = np.inf
+                    matched = labels[distances.argmin()]
+                if matched:
                     results.append(90 - j * 2)
-                    print(90 - j * 2)
                     break
         return results
 
-    def match(self, trend, i):
-        match = None
-        min_distance = None
+    def cached_flawed_test(self, cache_dir, window=None):
+        """ Does flawed_test with the distances kept in a cache directory.
+
+        There is one DistanceCache per prefix length, from the prefixes of
+        every trending trend to all of the trends, and the trends are hashed
+        once for all of them (see prefix_key). A cache is only opened once a
+        prefix of its length is needed, and a row is only filled in while
+        its trend has not matched a trending trend yet. Without a window,
+        the missing rows of a trend are filled from one OnlineDTW, extended
+        a window at a time as in flawed_test, and with one each row is
+        computed by DTW on its own.
+        """
+        labels = self.labels()
+        positives = np.flatnonzero(labels)
+        key = content_key(self.tensor[positives], self.lengths[positives],
+                          self.tensor, self.lengths, self.weights, window)
+        caches = {}
+        results = []
+        for k, i in enumerate(positives.tolist()):
+            online = OnlineDTW(self.tensor, self.lengths, self.weights) \
+                if window is None else None
+            done = 0
+            for j in range(1, 91):
+                if j not in caches:
+                    caches[j] = DistanceCache(
+                        cache_dir, self.tensor[positives, :j],
+                        np.minimum(self.lengths[positives], j), self.tensor,
+                        self.lengths, self.weights, window,
+                        key=prefix_key(key, j))
+                cache = caches[j]
+                if online is None or len(cache.missing([k])) == 0:
+                    row = np.array(cache.row(k))
+                else:
+                    # Catch up on the windows of rows that were cached
+                    n = min(j, int(self.lengths[i]))
+                    for cell in self.tensor[i, done:n]:
+                        distances = online.extend(cell)
+                    done = n
+                    cache.write(k, distances)
+                    row = np.array(distances)
+                row[i] = np.inf
+                if labels[row.argmin()]:
+                    results.append(90 - j * 2)
+                    break
+        return results
 
-        for j, trend_b in enumerate(self.trends):
-            if i == j:
-                continue
-            dist = dtw_distance(trend, trend_b)
-            if match is None:
-                match = j
-                min_distance = dist
-            else:
-                if dist < min_distance:
-                    match = j
-                    min_distance = dist
+    def match(self, trend, i, window=None, stats=None, candidates=None):
+        """ Returns whether the nearest trend other than trend i trends.
 
-        print(match)
-        print(min_distance)
-        if self.trends[match].data[0].trending:
+        The trend may be a TrendLine or a feature matrix. With a number of
+        candidates C, only the C trends the index gives it are searched (see
+        nearest_trends). The trends searched are sliced from the tensor, so
+        no TrendLines are created for them.
+        """
+        query = trend.features() if isinstance(trend, TrendLine) else trend
+        envelopes = self.envelopes(window)
+        chosen = np.arange(len(self.lengths))
+        if candidates is not None:
+            index = self.build_index() if self.index is None else self.index
+            # Nearest summaries first, so that the farthest one is dropped
+            chosen = index.candidates(query[np.newaxis], [len(query)],
+                                      candidates + 1, sort=False)[0]
+            chosen = np.sort(chosen[chosen != i][:candidates])
+            envelopes = [envelopes[j] for j in chosen]
+        references = [self.tensor[j, :self.lengths[j]] for j in chosen]
+        match, _ = nearest(query, references, self.weights, window,
+                           envelopes, exclude=i if candidates is None
+                           else None, stats=stats)
+        match = chosen[match]
+        if self.flags[match, 0]:
             return True
         else:
             return False
 
-    def leave_one_out(self):
+    def leave_one_out(self, window=None, stats=None, cache_dir=None,
+                      weights=None, n_jobs=-1, metric='dtw', candidates=None):
         """ Computes the leave-one-out precision and recall of the model.
 
         In the future, this may tune TopicCell weights until this is optimum.
-        For now, it just computes it.
+        For now, it just computes it. The window is an optional SakoeChiba or
+        Itakura constraint for the DTW distance, or FastDTW to approximate
+        it. The pruning counts of the nearest-neighbour searches are added to
+        stats if it is given. With a cache_dir, the full matrix of distances
+        is computed or read from there instead (see distances). The weights
+        default to those of the model, and n_jobs is the number of workers,
+        all cores by default. The metric and the number of candidates are
+        those of nearest_trends, and the cached matrix always has every
+        distance.
         """
-        true_positives = 0
-        true_negatives = 0
-        false_positives = 0
-        false_negatives = 0
-
-        mat = [trend for trend in self.trends]
-
-        parallel_results = Parallel(n_jobs=3)(delayed(trend_compare)(i, mat) for i in range(len(mat)))
-
-        for p_true_negatives, p_true_positives, p_false_negatives, p_false_positives in parallel_results:
-            true_positives += p_true_positives
-            true_negatives += p_true_negatives
-            false_negatives += p_false_negatives
-            false_positives += p_false_positives
-
-        precision = true_positives / (true_positives + false_positives)
-        recall = true_positives / (true_positives + false_negatives)
-
-        return precision, recall
+        if cache_dir is not None:
+            distances = self.distances(cache_dir, window=window,
+                                       weights=weights,
+                                       metric=metric).fill(n_jobs=n_jobs)
+            return precision_recall(*distance_compare(
+                distances, self.labels(), self.labels(), leave_one_out=True))
+        matches, _ = self.nearest_trends(window=window, weights=weights,
+                                         stats=stats, n_jobs=n_jobs,
+                                         metric=metric, candidates=candidates)
+        return precision_recall(*outcome_counts(self.labels(), self.labels(),
+                                                matches))
+
+    def candidate_recall(self, counts=(1, 2, 5, 10, 20, 50), window=None,
+                         n_jobs=-1):
+        """ Measures how often the index keeps the nearest trend as candidate.
+
+        Every trend is matched with its nearest other trend by a full search,
+        as in leave_one_out, and the index of the model, built first if it
+        has none, gives it its candidates for each of the counts.
+
+        :return: A list of every count C with the fraction of trends whose
+                 nearest trend is among their C candidates
+        """
+        index = self.build_index() if self.index is None else self.index
+        matches, _ = self.nearest_trends(window=window, n_jobs=n_jobs)
+        if len(matches) == 0:
+            return [(count, 1.0) for count in counts]
+        # The first C of the nearest summaries are the C candidates
+        ranked = index.candidates(self.tensor, self.lengths, max(counts),
+                                  exclude=True, sort=False)
+        found = ranked == matches[:, np.newaxis]
+        return [(count, float(found[:, :count].any(axis=1).mean()))
+                for count in counts]
+
+    def approximation_error(self, window=None, pairs=1000, seed=None):
+        """ Measures how far a DTW window is from exact DTW on this model.
+
+        The window defaults to a FastDTW of radius 1, and its distance is
+        compared with the exact DTW distance for a random sample of pairs
+        of trends, with the weights of the model. Since the window only
+        leaves out warping paths, its distance is never the smaller one.
+
+        :return: The mean and the largest error relative to the exact
+                 distance, the fraction of pairs given exactly the exact
+                 distance, and how many times faster the window computes
+        """
+        window = FastDTW() if window is None else window
+        rng = random.Random(seed)
+        n = len(self.trends)
+        sample = [rng.sample(range(n), 2) for _ in range(pairs)] \
+            if n > 1 else []
+        features = [self.tensor[i, :self.lengths[i]] for i in range(n)]
+        started = time.perf_counter()
+        exact = np.array([dtw(features[i], features[j], self.weights)
+                          for i, j in sample])
+        exact_time = time.perf_counter() - started
+        started = time.perf_counter()
+        approximate = np.array([dtw(features[i], features[j], self.weights,
+                                    window) for i, j in sample])
+        approximate_time = time.perf_counter() - started
+        if len(sample) == 0:
+            return 0.0, 0.0, 1.0, 1.0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            errors = np.where(approximate == exact, 0.0,
+                              (approximate - exact) / exact)
+        return float(errors.mean()), float(errors.max()), \
+            float(np.mean(approximate == exact)), \
+            exact_time / max(approximate_time, 1e-9)
 
     def serialize(self):
         """ Return a string encoding of the model. """
         return json.dumps(self, cls=TwitTPEncoder, ensure_ascii=False)
 
+    def to_obj(self):
+        """ Returns the model as plain Python objects, as from_obj reads. """
+        return {'trends': [trend.to_obj() for trend in self.trends]}
+
     def matrix(self):
-        """ Create a sparse matrix and output vector for the trends. """
-        width = max([len(trend.data) for trend in self.trends])
-        y = []
-        m = np.zeros((len(self.trends), width), dtype=('float64', 6))
-        for i, trend in enumerate(self.trends):
-            if trend.trending():
-                y.append(1)
-            else:
-                y.append(0)
-            for j, datum in enumerate(trend.data):
-                m[i, j] = (datum.count, datum.delta, datum.delta_delta,
-                           datum.avg_followers, datum.avg_statuses,
-                           datum.retweets, datum.lengths, datum.lexical_density)
+        """ Create a zero-padded feature tensor and output vector.
+
+        The tensor is trend x time window x feature, in FEATURES order, and
+        the output vector says which of the trends trend.
+        """
+        m = np.where(np.isnan(self.tensor), 0.0, self.tensor)
+        y = [1 if trending else 0 for trending in self.flags.any(axis=1)]
         return m, y
 
     def normalize(self):
         """ Modify the member trend cells to be normalized in [0,1].
 
-        :return:
+        Every feature but retweets is divided by its largest absolute value
+        in the trend, unless that is zero (see feature_scales). This is done
+        on the whole tensor at once. The trend x feature matrix of what the
+        features were divided by is kept in scales. A model loaded from a
+        store is read into memory first.
         """
-        for i, trend in enumerate(self.trends):
-            # Get the maxes for normalization
-            max_count = max([math.fabs(datum.count) for datum in trend.data])
-            max_delta = max([math.fabs(datum.delta) for datum in trend.data])
-            max_delta_delta = max([math.fabs(datum.delta_delta) for datum in trend.data])
-            max_followers = max([math.fabs(datum.avg_followers) for datum in trend.data])
-            max_statuses = max([math.fabs(datum.avg_statuses) for datum in trend.data])
-            max_length = max([math.fabs(datum.lengths) for datum in trend.data])
-            max_ld = max([math.fabs(datum.lexical_density) for datum in trend.data])
-            max_count = 1 if max_count == 0 else max_count
-            max_delta = 1 if max_delta == 0 else max_delta
-            max_delta_delta = 1 if max_delta_delta == 0 else max_delta_delta
-            max_statuses = 1 if max_statuses == 0 else max_statuses
-            max_followers = 1 if max_followers == 0 else max_followers
-            max_length = 1 if max_length == 0 else max_length
-            max_ld = 1 if max_ld == 0 else max_ld
-
-            for j, datum in enumerate(trend.data):
-                datum.count = datum.count / max_count
-                datum.delta = datum.delta / max_delta
-                datum.delta_delta = datum.delta_delta / max_delta_delta
-                datum.avg_followers = datum.avg_followers / max_followers
-                datum.avg_statuses = datum.avg_statuses / max_statuses
-                datum.lengths = datum.lengths / max_length
-                datum.lexical_density = datum.lexical_density / max_ld
+        if not self.tensor.flags.writeable:
+            self.tensor = np.array(self.tensor)
+            self.flags = np.array(self.flags)
+        scales = feature_scales(self.tensor, self.lengths)
+        self.tensor /= scales[:, np.newaxis]
+        self.scales = scales if self.scales is None else self.scales * scales
+        self._envelopes = {}
+        self.index = None
 
     @staticmethod
     def from_obj(obj):
@@ -335,20 +700,107 @@ class TrendModel:
         trends = [TrendLine.from_obj(trend) for trend in obj['trends']]
         return TrendModel(trends=trends)
 
+    def save(self, directory):
+        """ Writes the model to a store, a directory of .npy files.
+
+        The store holds the padded tensor, lengths and flags of the model
+        (see pack), the start timestamps and window sizes of the trends and,
+        if the model was normalized, its scales. If the model has an index,
+        the summaries of its trends are written too, and its tree is rebuilt
+        from them the first time the loaded model is searched. The names of
+        the trends and the version of the layout are kept in meta.json.
+        """
+        os.makedirs(directory, exist_ok=True)
+        columns = {'tensor': self.tensor, 'lengths': self.lengths,
+                   'flags': self.flags, 'scales': self.scales,
+                   'starts': np.array([trend.start_ts for trend in
+                                       self.trends], dtype=np.int64),
+                   'window_sizes': np.array([trend.window_size for trend in
+                                             self.trends], dtype=np.int64),
+                   'summaries': None if self.index is None
+                   else self.index.summaries}
+        for name, column in columns.items():
+            if column is not None:
+                np.save(os.path.join(directory, name + '.npy'), column)
+        with open(os.path.join(directory, 'meta.json'), 'w',
+                  encoding='utf-8') as f:
+            json.dump({'version': MODEL_VERSION, 'features': FEATURES,
+                       'normalized': self.scales is not None,
+                       'segments': None if self.index is None
+                       else self.index.segments,
+                       'names': [trend.name for trend in self.trends]}, f,
+                      ensure_ascii=False)
+
+    @staticmethod
+    def load(directory):
+        """ Opens a store written by save.
+
+        The arrays are memory-mapped read-only, so opening a model reads
+        none of its data, and the TrendLines are only created when they are
+        used (see ModelTrends). Only the parts of the tensor that are touched
+        are read from disk, and the tree of the index is only built from its
+        summaries when candidates are first asked for (see TrendIndex).
+        """
+        with open(os.path.join(directory, 'meta.json'),
+                  encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta['version'] != MODEL_VERSION or \
+                tuple(meta['features']) != FEATURES:
+            raise ValueError('Unsupported model store version {} with '
+                             'features {}'.format(meta['version'],
+                                                  meta['features']))
+        columns = {}
+        for name in ('tensor', 'lengths', 'flags', 'scales', 'starts',
+                     'window_sizes', 'summaries'):
+            path = os.path.join(directory, name + '.npy')
+            columns[name] = np.load(path, mmap_mode='r') \
+                if os.path.exists(path) else None
+        model = TrendModel()
+        model.tensor = columns['tensor']
+        model.lengths = columns['lengths']
+        model.flags = columns['flags']
+        model.scales = columns['scales']
+        if columns['summaries'] is not None:
+            model.index = TrendIndex(columns['summaries'], model.weights,
+                                     meta['segments'])
+        model.trends = ModelTrends(model, meta['names'], columns['starts'],
+                                   columns['window_sizes'])
+        return model
+
+    @staticmethod
+    def is_store(path):
+        """ Returns whether a path is a model store rather than JSON. """
+        return os.path.isfile(os.path.join(path, 'meta.json'))
+
+    @staticmethod
+    def convert(json_file, directory):
+        """ Converts a model serialized as JSON to a store.
+
+        The index of the model is built first, so that it is saved with it.
+        """
+        model = TrendModel.from_file(json_file)
+        model.build_index()
+        model.save(directory)
+
     @staticmethod
     def from_file(file):
         """ Convenience function to read a JSON obj from a file to an object.
 
+        A model store written by save is opened with load instead.
+
         :param file: The file to read from
         :return: The final Python object
         """
+        if TrendModel.is_store(file):
+            return TrendModel.load(file)
         with open(file, encoding="utf-8") as f:
             model_string = f.read()
             model_obj = json.loads(model_string)
             return TrendModel.from_obj(model_obj)
 
     @staticmethod
-    def model_from_files(trend_file, tweet_file, stopwords_file):
+    def model_from_files(trend_file, tweet_file, stopwords_file, n_jobs=1,
+                         tokenizer='nltk', bag_capacity=None):
         """ Constructs a TrendModel from tweets and trends.
 
         This high-level method uses a number of other static methods to build
@@ -356,13 +808,16 @@ class TrendModel:
         the trends from the trends file, creating "positive" trends from that,
         building a bag-of-words model of the tweets, creating "negative" trends
         from the positive trends and bag-of-words, then populating all of these
-        trends with data from the tweets.
+        trends with data from the tweets. The tweet file is decoded once, by
+        n_jobs processes, into a TweetTable that serves both, and the named
+        tokenizer is used for lexical density (see TOKENIZERS). With a
+        bag_capacity, the bag-of-words only keeps track of that many words
+        as the tweets are read (see HeavyHitters).
         """
         # Load the positive trends from the file
         twitter_trends = TwitterTrend.from_file(trend_file)
 
-        positive_trends = [TrendLine.from_twitter_trend(trend) for trend in
-                           twitter_trends]
+        positive_trends = TrendLine.from_twitter_trends(twitter_trends)
 
         # Remove any short trends
         positive_trends = [trend for trend in positive_trends if
@@ -377,20 +832,26 @@ class TrendModel:
 
         # Create negative trends using a bag of words model
         stopwords = Stopwords.from_csv(stopwords_file)
-        bag_of_words = BagOfWords.from_file(tweet_file, stopwords=stopwords)
+        tweets = TweetTable.from_file(tweet_file, n_jobs,
+                                      tokenizer=tokenizer,
+                                      stopwords=stopwords,
+                                      capacity=bag_capacity)
+        bag_of_words = tweets.bag_of_words(stopwords)
         negative_trends = TrendLine.construct_negative_trends(positive_trends,
                                                               bag_of_words)
 
         # Merge the trends and populate them using tweet data
         all_trends = positive_trends
         all_trends.extend(negative_trends)
-        TrendLine.populate_from_file(all_trends, tweet_file)
+        TrendLine.populate_from_table(all_trends, tweets, n_jobs)
         model = TrendModel(trends=all_trends)
         model.normalize()
+        model.build_index()
         return model
 
     @staticmethod
-    def new_model_from_files(trend_file, tweet_file, stopwords_file):
+    def new_model_from_files(trend_file, tweet_file, stopwords_file, n_jobs=1,
+                             tokenizer='nltk', bag_capacity=None):
         """ Constructs a TrendModel from tweets and trends.
 
         This high-level method uses a number of other static methods to build
@@ -398,13 +859,16 @@ class TrendModel:
         the trends from the trends file, creating "positive" trends from that,
         building a bag-of-words model of the tweets, creating "negative" trends
         from the positive trends and bag-of-words, then populating all of these
-        trends with data from the tweets.
+        trends with data from the tweets. The tweet file is decoded once, by
+        n_jobs processes, into a TweetTable that serves both, and the named
+        tokenizer is used for lexical density (see TOKENIZERS). With a
+        bag_capacity, the bag-of-words only keeps track of that many words
+        as the tweets are read (see HeavyHitters).
         """
         # Load the positive trends from the file
         twitter_trends = TwitterTrend.from_file(trend_file)
 
-        positive_trends = [TrendLine.from_twitter_trend(trend) for trend in
-                           twitter_trends]
+        positive_trends = TrendLine.from_twitter_trends(twitter_trends)
 
         # Remove any short trends
         positive_trends = [trend for trend in positive_trends if
@@ -417,20 +881,27 @@ class TrendModel:
             pt.start_ts -= 60 * TREND_PREEMT  # Subtract 3 hours from the ts
 
         stopwords = Stopwords.from_csv(stopwords_file)
-        bag_of_words = BagOfWords.from_file(tweet_file, stopwords=stopwords)
+        tweets = TweetTable.from_file(tweet_file, n_jobs,
+                                      tokenizer=tokenizer,
+                                      stopwords=stopwords,
+                                      capacity=bag_capacity)
+        bag_of_words = tweets.bag_of_words(stopwords)
         negative_trends = TrendLine.construct_negative_trends(positive_trends,
                                                               bag_of_words)
 
         # Merge the trends and populate them using tweet data
         all_trends = positive_trends
         all_trends.extend(negative_trends)
-        TrendLine.populate_from_file(all_trends, tweet_file)
+        TrendLine.populate_from_table(all_trends, tweets, n_jobs)
         model = TrendModel(trends=all_trends)
         model.normalize()
+        model.build_index()
         return model
 
     @staticmethod
-    def remaining_model_from_files(trend_file, tweet_file, stopwords_file):
+    def remaining_model_from_files(trend_file, tweet_file, stopwords_file,
+                                   n_jobs=1, tokenizer='nltk',
+                                   bag_capacity=None):
         """ Constructs a TrendModel from tweets and trends.
 
         This high-level method uses a number of other static methods to build
@@ -438,13 +909,16 @@ class TrendModel:
         the trends from the trends file, creating "positive" trends from that,
         building a bag-of-words model of the tweets, creating "negative" trends
         from the positive trends and bag-of-words, then populating all of these
-        trends with data from the tweets.
+        trends with data from the tweets. The tweet file is decoded once, by
+        n_jobs processes, into a TweetTable that serves both, and the named
+        tokenizer is used for lexical density (see TOKENIZERS). With a
+        bag_capacity, the bag-of-words only keeps track of that many words
+        as the tweets are read (see HeavyHitters).
         """
         # Load the positive trends from the file
         twitter_trends = TwitterTrend.from_file(trend_file)
 
-        positive_trends = [TrendLine.from_twitter_trend(trend) for trend in
-                           twitter_trends]
+        positive_trends = TrendLine.from_twitter_trends(twitter_trends)
 
         # Remove any short trends
         positive_trends = [trend for trend in positive_trends if
@@ -455,72 +929,53 @@ class TrendModel:
             pt.start_ts -= 60 * TREND_PREEMT  # Subtract 3 hours from the ts
 
         stopwords = Stopwords.from_csv(stopwords_file)
-        bag_of_words = BagOfWords.from_file(tweet_file, stopwords=stopwords)
+        tweets = TweetTable.from_file(tweet_file, n_jobs,
+                                      tokenizer=tokenizer,
+                                      stopwords=stopwords,
+                                      capacity=bag_capacity)
+        bag_of_words = tweets.bag_of_words(stopwords)
         negative_trends = TrendLine.construct_negative_trends(positive_trends,
                                                               bag_of_words)
 
         # Merge the trends and populate them using tweet data
         all_trends = positive_trends
         all_trends.extend(negative_trends)
-        TrendLine.populate_from_file(all_trends, tweet_file)
+        TrendLine.populate_from_table(all_trends, tweets, n_jobs)
         model = TrendModel(trends=all_trends)
         model.normalize()
+        model.build_index()
         return model
 
-    def knockout(self):
+    def knockout(self, cache_dir=None, window=None, n_jobs=-1):
         """ Perform a knockout test on a model's features.
 
-        :return: A map from the features to the P/R of their knockout
-        """
-        results = {}
-        for trend in self.trends:
-            for datum in trend.data:
-                datum.COUNT_WEIGHT = 0.0
-        results['count'] = self.leave_one_out()
-
-        for trend in self.trends:
-            for datum in trend.data:
-                datum.COUNT_WEIGHT = 1.0
-                datum.DELTA_WEIGHT = 0.0
-        results['delta'] = self.leave_one_out()
-
-        for trend in self.trends:
-            for datum in trend.data:
-                datum.DELTA_WEIGHT = 1.0
-                datum.DELTA_DELTA_WEIGHT = 0.0
-        results['delta_delta'] = self.leave_one_out()
-
-        for trend in self.trends:
-            for datum in trend.data:
-                datum.DELTA_DELTA_WEIGHT = 1.0
-                datum.FOLLOWERS_WEIGHT = 0.0
-        results['followers'] = self.leave_one_out()
-
-        for trend in self.trends:
-            for datum in trend.data:
-                datum.FOLLOWERS_WEIGHT = 1.0
-                datum.STATUSES_WEIGHT = 0.0
-        results['statuses'] = self.leave_one_out()
-
-        for trend in self.trends:
-            for datum in trend.data:
-                datum.STATUSES_WEIGHT = 1.0
-                datum.RETWEETS_WEIGHT = 0.0
-        results['retweets'] = self.leave_one_out()
-
-        for trend in self.trends:
-            for datum in trend.data:
-                datum.RETWEETS_WEIGHT = 1.0
-                datum.LENGTHS_WEIGHT = 0.0
-        results['lengths'] = self.leave_one_out()
-
-        for trend in self.trends:
-            for datum in trend.data:
-                datum.LENGTHS_WEIGHT = 1.0
-                datum.LEXICAL_DENSITY_WEIGHT = 0.0
-        results['ld'] = self.leave_one_out()
-
-        return results
+        Each feature in turn gets a weight of zero while the others keep the
+        weights of the model, and the baseline keeps all of them. The nine
+        leave-one-out runs are done as one job (see nearest_trends), and for
+        every pair of trends the local costs of all nine weight vectors are
+        computed together. The model itself is not modified.
+
+        :param cache_dir: An optional directory to keep distance matrices in
+        :param window: An optional SakoeChiba or Itakura DTW constraint, or
+                       FastDTW
+        :param n_jobs: The number of joblib workers, all cores by default
+        :return: A map from the features, and 'baseline', to their P/R
+        """
+        names = ('baseline',) + KNOCKOUT_NAMES
+        weight_sets = np.tile(self.weights, (len(names), 1))
+        for k in range(len(KNOCKOUT_NAMES)):
+            weight_sets[k + 1, k] = 0.0
+        if cache_dir is not None:
+            return {name: self.leave_one_out(window, cache_dir=cache_dir,
+                                             weights=weights, n_jobs=n_jobs)
+                    for name, weights in zip(names, weight_sets)}
+
+        matches, _ = self.nearest_trends(window=window, weights=weight_sets,
+                                         n_jobs=n_jobs)
+        labels = self.labels()
+        return {name: precision_recall(*outcome_counts(labels, labels,
+                                                       matches[:, k]))
+                for k, name in enumerate(names)}
 
 
 class TrendLine:
@@ -528,9 +983,10 @@ class TrendLine:
 
     A "trend line" is considered some list of data over consecutive time
     quanta. By default, we assume each window is two minutes, but this can be
-    overridden. Also, for now that data is a list of TrendCell, but we could
-    generalize more (and I probably will when experimenting with other
-    properties to use for trend detection).
+    overridden. The data is stored as a float64 matrix of time window x
+    feature (in FEATURES order) and a boolean array of whether each window is
+    trending. The data attribute still reads and writes it as a list of
+    TrendCell, each of which is a view of one row.
     """
 
     def __init__(self, name, start_ts, data=None, window_size=120):
@@ -548,6 +1004,27 @@ class TrendLine:
         self.data = [] if data is None else data
         self.window_size = window_size
 
+    @property
+    def data(self):
+        """ The data points of the TrendLine as a sequence of TrendCell. """
+        return TrendCells(self._features, self._flags)
+
+    @data.setter
+    def data(self, cells):
+        """ Copies a list of TrendCell into new storage for the TrendLine. """
+        cells = list(cells)
+        features = np.empty((len(cells), len(FEATURES)))
+        flags = np.empty(len(cells), dtype=bool)
+        for k, cell in enumerate(cells):
+            features[k] = cell.values()
+            flags[k] = cell.trending
+        self.attach(features, flags)
+
+    def attach(self, features, flags):
+        """ Backs the TrendLine with the given feature and flag arrays. """
+        self._features = features
+        self._flags = flags
+
     def match_text(self, text):
         """ Determines whether a piece of text matches the trend. """
         for word in self.name.split():
@@ -560,29 +1037,44 @@ class TrendLine:
 
         This is measured by finding the alignment of the shorter TrendLine
         against that longer one than minimizes the sum of the distances between
-        corresponding data members.
-        """
-        # Distance is symmetric, so just define it for self < other
-        if len(self.data) > len(other.data):
-            return other.distance(self)
-
-        min_distance = None
-        for offset in range(len(other.data) - len(self.data) + 1):
-            total = 0
-            for i in range(len(self.data)):
-                total += self.data[i].distance(other.data[offset + i])
-            if min_distance is None:
-                min_distance = total
-            elif min_distance > total:
-                min_distance = total
-        return min_distance
+        corresponding data members. All alignments are evaluated at once (see
+        twittp.sliding).
+        """
+        return sliding_distance(self.features(), other.features(),
+                                TrendCell.weights())
+
+    def features(self):
+        """ Returns the data as a float64 matrix of time window x feature.
+
+        This is the storage of the TrendLine itself, not a copy.
+        """
+        return self._features
+
+    def flags(self):
+        """ Returns the trending flag of every time window. """
+        return self._flags
 
     def trending(self):
         """ Indicates if this TrendLine ever trends on Twitter. """
-        for datum in self.data:
-            if datum.trending:
-                return True
-        return False
+        return bool(self._flags.any())
+
+    def to_obj(self):
+        """ Returns the TrendLine as plain Python objects for serializing. """
+        data = []
+        for trending, values in zip(self._flags.tolist(),
+                                    self._features.tolist()):
+            cell = {'trending': trending}
+            cell.update(zip(FEATURES, values))
+            data.append(cell)
+        return {'name': self.name, 'start_ts': self.start_ts, 'data': data,
+                'window_size': self.window_size}
+
+    @staticmethod
+    def from_arrays(name, start_ts, features, flags, window_size=120):
+        """ Creates a TrendLine backed by existing feature and flag arrays. """
+        trend = TrendLine(name, start_ts, window_size=window_size)
+        trend.attach(features, flags)
+        return trend
 
     @staticmethod
     def from_obj(obj):
@@ -592,16 +1084,22 @@ class TrendLine:
         name = obj['name']
         window_size = obj['window_size']
         start_ts = obj['start_ts']
-        data = [TrendCell.from_obj(cell) for cell in obj['data']]
-        return TrendLine(name, start_ts, data, window_size)
+        features = np.array([[cell[feature] for feature in FEATURES]
+                             for cell in obj['data']], dtype=np.float64)
+        flags = np.array([cell['trending'] for cell in obj['data']],
+                         dtype=bool)
+        return TrendLine.from_arrays(name, start_ts,
+                                     features.reshape(-1, len(FEATURES)),
+                                     flags, window_size)
 
     @staticmethod
     def random_trend(name, start, end, lengths):
         """ Creates an empty TrendLine of length sampled from lengths. """
         length = lengths[random.randrange(0, len(lengths))]
         start_trend = random.randint(start // 120, (end // 120) - length)
-        data = [TrendCell(trending=False) for _ in range(length)]
-        return TrendLine(name, start_ts=start_trend*120, data=data)
+        return TrendLine.from_arrays(name, start_trend*120,
+                                     np.zeros((length, len(FEATURES))),
+                                     np.zeros(length, dtype=bool))
 
     @staticmethod
     def construct_negative_trends(trends, bag_of_words):
@@ -622,109 +1120,151 @@ class TrendLine:
                 names]
 
     @staticmethod
-    def populate_from_file(trends, tweet_file):
+    def populate_from_file(trends, tweet_file, n_jobs=1, tokenizer='nltk'):
         """ Fills data of a list of TrendLines from JSON file of tweet objects.
 
-        This works in two passes -- first the counts are filled in by reading
-        each tweet from the JSON file (one tweet per line), and incrementing
-        the count if there is a match between the text and the trend and the
-        Tweet falls in the range of the trend.
-
-        The second pass consists of going through each trend that was passed to
-        the method and filling in the delta and delta_delta of the data from
-        the counts that were just loaded in.
-        """
-        with open(tweet_file, encoding='utf-8') as f:
-            # Memoize the ending timestamps for our trends to speed things up
-            end_ts = {}
-            for i, trend in enumerate(trends):
-                end_ts[i] = trend.start_ts + (trend.window_size * len(trend.data))
-
-            for line in f:
-                tweet = json.loads(line)
-                words = tweet['text'].split()
-                dt = datetime.strptime(tweet['created_at'],
-                                       "%a %b %d %H:%M:%S %z %Y")
-                ts = (dt - datetime(1970, 1, 1, tzinfo=timezone(timedelta(0))))\
-                    // timedelta(seconds=1)
-                for i, trend in enumerate(trends):
-                    if trend.start_ts <= ts < end_ts[i] and \
-                            trend.match_text(words):
-                        offset = (ts - trend.start_ts) // trend.window_size
-                        words = nltk.tokenize.word_tokenize(tweet['text'])
-                        trend.data[offset].count += 1
-                        trend.data[offset].avg_followers += tweet['user_followers']
-                        trend.data[offset].avg_statuses += tweet['user_statuses']
-                        trend.data[offset].lengths += len(tweet['text'])
-                        trend.data[offset].lexical_density += 0 if len(words) == 0 \
-                            else len(set(words)) / len(words)
-                        retweets = trend.data[offset].retweets
-                        trend.data[offset].retweets = retweets + 1 if tweet['retweeted'] else retweets
+        The file is read into a TweetTable by n_jobs processes, which then
+        populates the trends (see populate_from_table).
+        """
+        tweets = TweetTable.from_file(tweet_file, n_jobs, tokenizer=tokenizer)
+        TrendLine.populate_from_table(trends, tweets, n_jobs)
+
+    @staticmethod
+    def populate_from_table(trends, tweets, n_jobs=1):
+        """ Fills data of a list of TrendLines from a TweetTable.
+
+        This works in two passes -- first the counts are filled in by going
+        through each tweet, and incrementing the count if there is a match
+        between the text and the trend and the Tweet falls in the range of the
+        trend (see aggregate_tweets). With n_jobs other than 1, the tweets are
+        split into that many runs for joblib workers, and the totals of the
+        runs are added to the trends in order, which gives the same data as
+        one process.
+
+        The second pass turns the totals of all trends into averages and
+        fills in the delta and delta_delta of the data from the counts that
+        were just loaded in (see derive_features). For this the trends are
+        moved into one padded tensor first, as in TrendModel.pack.
+        """
+        tensor, _, lengths = pack_trends(trends)
+        spans = [(trend.name, trend.start_ts, trend.window_size,
+                  len(trend.data)) for trend in trends]
+        names = NameMatcher([trend.name for trend in trends])
+        named = np.array([word in names for word in tweets.vocabulary],
+                         dtype=bool)
+        bounds = np.linspace(0, len(tweets),
+                             effective_n_jobs(n_jobs) + 1).astype(int)
+        if len(bounds) <= 2:
+            partials = [aggregate_tweets(tweets, 0, len(tweets), spans,
+                                         named)]
+        else:
+            partials = Parallel(n_jobs=n_jobs)(delayed(aggregate_tweets)(
+                tweets, start, stop, spans, named)
+                for start, stop in zip(bounds[:-1], bounds[1:]))
+        for partial in partials:
+            for (i, offset), totals in partial.items():
+                totals.add_to(trends[i].data[offset])
 
         # Second pass
-        for trend in trends:
-            first = True
-            second = False
-            for index in range(len(trend.data)):
-                datum = trend.data[index]
-
-                if datum.count > 0:
-                    datum.avg_followers = datum.avg_followers / datum.count
-                    datum.avg_statuses = datum.avg_statuses / datum.count
-                    datum.retweets = datum.retweets / datum.count
-                    datum.lengths = datum.lengths / datum.count
-                    datum.lexical_density = datum.lexical_density / datum.count
-
-                if first:
-                    datum.delta = 0
-                    datum.delta_delta = 0
-                    first = False
-                    second = True
-                elif second:
-                    datum.delta = datum.count - trend.data[index - 1].count
-                    datum.delta_delta = 0
-                    second = False
-                else:
-                    datum.delta = datum.count - trend.data[index - 1].count
-                    datum.delta_delta = datum.delta - trend.data[index - 1].delta
+        derive_features(tensor, lengths)
 
     @staticmethod
     def from_twitter_trend(twitter_trend, window_size=120):
         """ Converts a TwitterTrend into a TrendLine.
 
         The TrendLine represents the longest consecutive time windows where this
-        trend is "trending" according to Twitter.
+        trend is "trending" according to Twitter, the earliest of them if
+        there are several.
+        """
+        return TrendLine.from_twitter_trends([twitter_trend], window_size)[0]
+
+    @staticmethod
+    def from_twitter_trends(twitter_trends, window_size=120):
+        """ Converts a list of TwitterTrends into TrendLines.
+
+        This is from_twitter_trend for every trend, with the longest runs of
+        all of them found at once (see TwitterTrend.longest_runs).
         """
-        longest_consecutive = 0
-        start_longest = None
+        starts, lengths = TwitterTrend.longest_runs(twitter_trends,
+                                                    window_size)
+        return [TrendLine.from_arrays(twitter_trend.name, start,
+                                      np.zeros((length, len(FEATURES))),
+                                      np.ones(length, dtype=bool),
+                                      window_size=window_size)
+                for twitter_trend, start, length in
+                zip(twitter_trends, starts, lengths.tolist())]
 
-        start_consecutive = None
-        current_consecutive = 0
-        last_timestamp = None
 
-        for ts in twitter_trend.timestamps:
-            if start_consecutive is None:
-                start_consecutive = ts
-                current_consecutive = 1
-            elif ts == last_timestamp + window_size:
-                current_consecutive += 1
-            else:
-                if start_longest is None:
-                    start_longest = start_consecutive
-                    longest_consecutive = current_consecutive
-                elif longest_consecutive < current_consecutive:
-                    start_longest = start_consecutive
-                    longest_consecutive = current_consecutive
-                else:
-                    start_consecutive = None
-                    current_consecutive = 0
+class ModelTrends(Sequence):
+    """ The trends of a TrendModel loaded from a store.
+
+    Each TrendLine is created when it is indexed and is backed by its slice
+    of the arrays of the model, as after TrendModel.pack.
+    """
 
-            last_timestamp = ts
+    def __init__(self, model, names, starts, window_sizes):
+        """ Constructor for ModelTrends over the arrays of a model. """
+        self.model = model
+        self.names = names
+        self.starts = starts
+        self.window_sizes = window_sizes
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[k] for k in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('TrendLine index out of range')
+        n = self.model.lengths[index]
+        return TrendLine.from_arrays(self.names[index],
+                                     int(self.starts[index]),
+                                     self.model.tensor[index, :n],
+                                     self.model.flags[index, :n],
+                                     int(self.window_sizes[index]))
+
+
+class TrendCells(Sequence):
+    """ The data of a TrendLine as a read-only sequence of TrendCell views.
+
+    Cells are created when they are indexed, so taking the length or one
+    cell of a long TrendLine is cheap.
+    """
+
+    def __init__(self, features, flags):
+        """ Constructor for TrendCells over the arrays of a TrendLine. """
+        self.features = features
+        self.flags = flags
+
+    def __len__(self):
+        return len(self.flags)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[k] for k in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('TrendCell index out of range')
+        return TrendCell.view(self.features, self.flags, index)
+
+
+class FeatureColumn:
+    """ Descriptor for one feature of a TrendCell, backed by an array. """
+
+    def __init__(self, column):
+        self.column = column
 
-        data = [TrendCell(True) for _ in range(longest_consecutive)]
+    def __get__(self, cell, owner):
+        if cell is None:
+            return self
+        return float(cell._features[cell._index, self.column])
 
-        return TrendLine(twitter_trend.name, start_longest, data=data,
-                         window_size=window_size)
+    def __set__(self, cell, value):
+        cell._features[cell._index, self.column] = value
 
 
 class TrendCell:
@@ -733,7 +1273,13 @@ class TrendCell:
     In particular, this is one where the only variables of concern are the
     number of matching Tweets at this time, the change since the last time, and
     the change in the change since the last time.
+
+    A TrendCell holds no data itself. It is a view of one row of the arrays
+    of a TrendLine (see TrendLine.data), or of a one-row array of its own when
+    it is constructed directly.
     """
+    __slots__ = ('_features', '_flags', '_index')
+
     COUNT_WEIGHT = 1.0
     DELTA_WEIGHT = 1.0
     DELTA_DELTA_WEIGHT = 1.0
@@ -751,15 +1297,41 @@ class TrendCell:
         is whether the TrendLine is trending at this time or not. By "trending",
         we mean whatever Twitter uses to determine if a topic is trending.
         """
-        self.trending = trending
-        self.count = count
-        self.delta = delta
-        self.delta_delta = delta_delta
-        self.avg_followers = avg_followers
-        self.avg_statuses = avg_statuses
-        self.retweets = retweets
-        self.lengths = lengths
-        self.lexical_density = lexical_density
+        self._features = np.array([[count, delta, delta_delta, avg_followers,
+                                    avg_statuses, retweets, lengths,
+                                    lexical_density]], dtype=np.float64)
+        self._flags = np.array([trending], dtype=bool)
+        self._index = 0
+
+    count = FeatureColumn(0)
+    delta = FeatureColumn(1)
+    delta_delta = FeatureColumn(2)
+    avg_followers = FeatureColumn(3)
+    avg_statuses = FeatureColumn(4)
+    retweets = FeatureColumn(5)
+    lengths = FeatureColumn(6)
+    lexical_density = FeatureColumn(7)
+
+    @property
+    def trending(self):
+        return bool(self._flags[self._index])
+
+    @trending.setter
+    def trending(self, trending):
+        self._flags[self._index] = trending
+
+    @staticmethod
+    def view(features, flags, index):
+        """ Creates a TrendCell for row index of feature and flag arrays. """
+        cell = TrendCell.__new__(TrendCell)
+        cell._features = features
+        cell._flags = flags
+        cell._index = index
+        return cell
+
+    def values(self):
+        """ Returns the features of this cell as an array, FEATURES order. """
+        return self._features[self._index]
 
     def distance(self, other):
         """ Find the distance between two TrendCells.
@@ -768,15 +1340,32 @@ class TrendCell:
         delta_delta of the TrendCells in distance computation. Optimal weights
         need to be determined experimentally, but for now 1.0 placeholders are
         present.
+
+        The features are squared by multiplication and summed in FEATURES
+        order, as the kernels of twittp.dtw and twittp.sliding do, so that
+        they agree to the last bit.
         """
-        return math.sqrt(self.COUNT_WEIGHT * ((self.count - other.count) ** 2) +
-                         self.DELTA_WEIGHT * ((self.delta - other.delta) ** 2) +
-                         self.DELTA_DELTA_WEIGHT * ((self.delta_delta - other.delta_delta) ** 2) +
-                         self.FOLLOWERS_WEIGHT * ((self.avg_followers - other.avg_followers) ** 2) +
-                         self.STATUSES_WEIGHT * ((self.avg_statuses - other.avg_statuses) ** 2) +
-                         self.RETWEETS_WEIGHT * ((self.retweets - other.retweets) ** 2) +
-                         self.LENGTHS_WEIGHT * ((self.lengths - other.lengths) ** 2) +
-                         self.LEXICAL_DENSITY_WEIGHT * ((self.lexical_density - other.lexical_density) ** 2))
+        total = 0.0
+        for weight, a, b in zip(self.weights().tolist(),
+                                self.values().tolist(),
+                                other.values().tolist()):
+            diff = a - b
+            total += weight * (diff * diff)
+        return math.sqrt(total)
+
+    @classmethod
+    def weights(cls):
+        """ Returns the distance weights of TrendCells in FEATURES order. """
+        return np.array([cls.COUNT_WEIGHT, cls.DELTA_WEIGHT,
+                         cls.DELTA_DELTA_WEIGHT, cls.FOLLOWERS_WEIGHT,
+                         cls.STATUSES_WEIGHT, cls.RETWEETS_WEIGHT,
+                         cls.LENGTHS_WEIGHT, cls.LEXICAL_DENSITY_WEIGHT])
+
+    def to_obj(self):
+        """ Returns the TrendCell as plain Python objects for serializing. """
+        obj = {'trending': self.trending}
+        obj.update(zip(FEATURES, self.values().tolist()))
+        return obj
 
     @staticmethod
     def from_obj(obj):
@@ -795,5 +1384,5 @@ class TwitTPEncoder(json.JSONEncoder):
         """ This overridden default() handles TwitTP objects properly. """
         if isinstance(o, TrendModel) or isinstance(o, TrendLine) or \
                 isinstance(o, TrendCell):
-            return o.__dict__
+            return o.to_obj()
         return super(TwitTPEncoder, self).default(o)
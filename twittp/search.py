@@ -0,0 +1,232 @@
+from collections.abc import Sequence
+import numpy as np
+from scipy.ndimage import maximum_filter1d, minimum_filter1d
+from .dtw import SakoeChiba, band, dtw, pair_cost
+
+
+class Envelope:
+    """ The lower and upper envelope of a reference trend line.
+
+    The global envelope is the per-feature minimum and maximum over the whole
+    line, which bounds any warping window. If a radius is given, the envelope
+    over every window of that radius is kept too, which is what LB_Keogh uses
+    under a SakoeChiba constraint of the same radius.
+    """
+
+    def __init__(self, features, radius=None):
+        """ Constructor for Envelope from a time window x feature matrix. """
+        self.radius = radius
+        self.lower = features.min(axis=0)
+        self.upper = features.max(axis=0)
+        if radius is None:
+            self.window_lower = None
+            self.window_upper = None
+        else:
+            size = 2 * radius + 1
+            self.window_lower = minimum_filter1d(features, size, axis=0,
+                                                 mode='nearest')
+            self.window_upper = maximum_filter1d(features, size, axis=0,
+                                                 mode='nearest')
+
+    @staticmethod
+    def from_arrays(lower, upper, radius=None, window_lower=None,
+                    window_upper=None):
+        """ Creates an Envelope backed by existing arrays. """
+        envelope = Envelope.__new__(Envelope)
+        envelope.radius = radius
+        envelope.lower = lower
+        envelope.upper = upper
+        envelope.window_lower = window_lower
+        envelope.window_upper = window_upper
+        return envelope
+
+    @staticmethod
+    def radius_for(window):
+        """ Returns the envelope radius that serves a DTW window, if any. """
+        if isinstance(window, SakoeChiba):
+            return window.radius
+        return None
+
+
+class Envelopes(Sequence):
+    """ The Envelopes of all trends of a padded tensor, as padded arrays.
+
+    The global envelopes are trend x feature arrays and, with a radius, the
+    windowed envelopes are trend x time window x feature arrays shaped like
+    the tensor. Being a few large arrays rather than an Envelope per trend,
+    they are handed to joblib workers as memory maps, as the tensor is.
+    Indexing gives the Envelope of one trend, backed by views of them.
+    """
+
+    def __init__(self, tensor, lengths, radius=None):
+        """ Constructor for Envelopes from a tensor and its lengths.
+
+        The padding past the end of each trend is left out of the minimums
+        and maximums, so every envelope is that of the trend on its own.
+        """
+        self.radius = radius
+        self.lengths = np.asarray(lengths)
+        inside = (np.arange(tensor.shape[1]) <
+                  self.lengths[:, np.newaxis])[..., np.newaxis]
+        above = np.where(inside, tensor, np.inf)
+        below = np.where(inside, tensor, -np.inf)
+        self.lower = above.min(axis=1)
+        self.upper = below.max(axis=1)
+        if radius is None:
+            self.window_lower = None
+            self.window_upper = None
+        else:
+            size = 2 * radius + 1
+            self.window_lower = minimum_filter1d(above, size, axis=1,
+                                                 mode='nearest')
+            self.window_upper = maximum_filter1d(below, size, axis=1,
+                                                 mode='nearest')
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, index):
+        if self.radius is None:
+            return Envelope.from_arrays(self.lower[index], self.upper[index])
+        n = self.lengths[index]
+        return Envelope.from_arrays(self.lower[index], self.upper[index],
+                                    self.radius,
+                                    self.window_lower[index, :n],
+                                    self.window_upper[index, :n])
+
+
+class PruneStats:
+    """ Counts what happened to the candidates of nearest-neighbour searches.
+
+    Every candidate is either pruned by LB_Kim, pruned by LB_Keogh, abandoned
+    part way through DTW, or has its full DTW distance computed.
+    """
+
+    def __init__(self, candidates=0, kim=0, keogh=0, abandoned=0, computed=0):
+        """ Constructor for PruneStats, normally with every count at zero. """
+        self.candidates = candidates
+        self.kim = kim
+        self.keogh = keogh
+        self.abandoned = abandoned
+        self.computed = computed
+
+    def add(self, other):
+        """ Adds the counts of another PruneStats to these. """
+        self.candidates += other.candidates
+        self.kim += other.kim
+        self.keogh += other.keogh
+        self.abandoned += other.abandoned
+        self.computed += other.computed
+
+    def pruned(self):
+        """ The fraction of candidates whose full DTW was not needed. """
+        if self.candidates == 0:
+            return 0.0
+        return 1 - self.computed / self.candidates
+
+    def __str__(self):
+        return ('{} candidates: {} pruned by LB_Kim, {} pruned by LB_Keogh, '
+                '{} abandoned early, {} full DTW ({:.1%} pruned)').format(
+            self.candidates, self.kim, self.keogh, self.abandoned,
+            self.computed, self.pruned())
+
+
+def lb_kim(query, reference, weights):
+    """ Lower bound on DTW from the first and last cells.
+
+    Every warping path starts at (0, 0) and ends at (n - 1, m - 1), so the sum
+    of their local costs can not be more than the DTW distance. Like dtw, this
+    takes a K x feature matrix of weights to give K bounds at once.
+    """
+    if len(query) == 1 and len(reference) == 1:
+        return pair_cost(query, reference, 0, 0, weights)
+    i = np.array([0, len(query) - 1])
+    j = np.array([0, len(reference) - 1])
+    cost = pair_cost(query, reference, i, j, weights)
+    return cost[0] + cost[1]
+
+
+def lb_keogh(query, envelope, m, weights, window=None):
+    """ Lower bound on DTW from the envelope of the reference.
+
+    Every warping path visits every row of the matrix at least once, and in
+    row i only columns inside the band. The local cost there is at least the
+    distance from query[i] to the box spanned by the reference envelope over
+    those columns. Rows whose band is exactly the SakoeChiba window of the
+    envelope use the windowed envelope, all others the global one. Like dtw,
+    this takes a K x feature matrix of weights to give K bounds at once.
+    """
+    n = len(query)
+    lower = np.broadcast_to(envelope.lower, query.shape)
+    upper = np.broadcast_to(envelope.upper, query.shape)
+    if envelope.radius is not None and \
+            Envelope.radius_for(window) == envelope.radius:
+        center = SakoeChiba.centers(n, m)
+        lo, hi = band(window, n, m)
+        exact = (lo == np.maximum(center - envelope.radius, 0)) & \
+            (hi == np.minimum(center + envelope.radius, m - 1))
+        lower = np.where(exact[:, np.newaxis],
+                         envelope.window_lower[center], lower)
+        upper = np.where(exact[:, np.newaxis],
+                         envelope.window_upper[center], upper)
+    outside = np.maximum(query - upper, 0) + np.maximum(lower - query, 0)
+    rows = np.arange(n)
+    return pair_cost(outside, np.zeros_like(outside), rows, rows,
+                     weights).sum(axis=0)
+
+
+def nearest(query, references, weights, window=None, envelopes=None,
+            exclude=None, stats=None):
+    """ Finds the reference closest to the query by DTW distance.
+
+    Candidates are visited in order of LB_Kim, so once LB_Kim exceeds the best
+    distance so far every remaining candidate is pruned. The others are then
+    checked against LB_Keogh, and the survivors have their DTW computed with
+    early abandoning at the best distance so far. The result is the same as a
+    brute-force search, including taking the first of equally near references.
+
+    The references are feature matrices and envelopes their Envelopes. The
+    reference with index exclude is skipped. Returns the index of the nearest
+    reference and its distance, and adds the pruning counts to stats if given.
+
+    With a K x feature matrix of weights, the K searches are done together,
+    sharing the local costs, and arrays of K indices and distances returned.
+    A candidate is then only pruned or abandoned if it is for all K.
+    """
+    if envelopes is None:
+        radius = Envelope.radius_for(window)
+        envelopes = [Envelope(reference, radius) for reference in references]
+    batch = np.ndim(weights) == 2
+    weights = np.atleast_2d(weights)
+    search = PruneStats(candidates=len(references))
+    if exclude is not None and 0 <= exclude < len(references):
+        search.candidates -= 1
+    kim = np.array([lb_kim(query, reference, weights)
+                    for reference in references]).reshape(-1, len(weights))
+    order = np.argsort(kim[:, 0], kind='stable')
+    match = np.full(len(weights), -1)
+    min_distance = np.full(len(weights), np.inf)
+    for j in order:
+        if j == exclude:
+            continue
+        if np.all(kim[j] > min_distance):
+            search.kim += 1
+            continue
+        reference = references[j]
+        if np.all(lb_keogh(query, envelopes[j], len(reference), weights,
+                           window) > min_distance):
+            search.keogh += 1
+            continue
+        dist = dtw(query, reference, weights, window, min_distance)
+        if np.all(dist == np.inf):
+            search.abandoned += 1
+            continue
+        search.computed += 1
+        better = (dist < min_distance) | ((dist == min_distance) & (j < match))
+        match[better] = j
+        min_distance[better] = dist[better]
+    if stats is not None:
+        stats.add(search)
+    if not batch:
+        return (None if match[0] < 0 else int(match[0])), min_distance[0]
+    return match, min_distance
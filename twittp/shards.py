@@ -0,0 +1,38 @@
+import os
+
+
+def byte_shards(path, n):
+    """ Splits a file of lines into at most n byte ranges of whole lines.
+
+    The ranges are [start, end) offsets of roughly equal size, each moved
+    forward to the start of the next line, so that every line of the file
+    falls in exactly one of them. Reading the ranges in order gives the lines
+    of the file in order.
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as f:
+        for k in range(1, n):
+            target = size * k // n
+            if target <= bounds[-1]:
+                continue
+            f.seek(target - 1)
+            f.readline()
+            if f.tell() >= size:
+                break
+            if f.tell() > bounds[-1]:
+                bounds.append(f.tell())
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def read_lines(path, start=0, end=None):
+    """ Yields the lines of a UTF-8 file that start in the byte range. """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        position = start
+        for line in f:
+            if end is not None and position >= end:
+                break
+            position += len(line)
+            yield line.decode('utf-8')
@@ -0,0 +1,108 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# The distances between trend lines that do not warp time
+METRICS = ('sliding', 'euclidean')
+
+
+def cell_cost(a, b, weights, squared=False):
+    """ Computes the weighted euclidean distance between cells a and b.
+
+    The features are the first axis of a and b, and the rest are broadcast
+    against each other. The features are accumulated one at a time and in
+    order so the result matches TrendCell.distance to the last bit, in two
+    buffers that are reused for every feature. With squared, the square of
+    the distance is returned instead.
+    """
+    shape = np.broadcast_shapes(a.shape[1:], b.shape[1:])
+    diff = np.empty(shape)
+    total = np.empty(shape)
+    np.subtract(a[0], b[0], out=diff)
+    np.multiply(diff, diff, out=diff)
+    np.multiply(weights[0], diff, out=total)
+    for f in range(1, len(a)):
+        np.subtract(a[f], b[f], out=diff)
+        np.multiply(diff, diff, out=diff)
+        np.multiply(weights[f], diff, out=diff)
+        total += diff
+    if not squared:
+        np.sqrt(total, out=total)
+    return total
+
+
+def alignment_costs(short, long, weights, squared=False, lengths=None):
+    """ Computes the cost of aligning short series at every offset of long
+    ones.
+
+    Short is a series x n x feature tensor and long a series x m x feature
+    tensor with m >= n, and one of them holds a single series. The cost of
+    offset o is the sum over i of the cell_cost of short[i] and long[o + i],
+    summed in order. The windows of the long series are views made by
+    sliding_window_view of a feature-major copy, so every offset is
+    evaluated at once with one pass over the n cells of the short series,
+    reading contiguous memory. If the lengths of the short series are
+    given, the cells past the end of each add nothing.
+
+    :return: The costs, one row per series and one column per offset
+    """
+    n = short.shape[1]
+    total = np.zeros((max(len(short), len(long)), long.shape[1] - n + 1))
+    short = np.moveaxis(short, -1, 0)
+    windows = sliding_window_view(
+        np.ascontiguousarray(np.moveaxis(long, -1, 0)), n, axis=2)
+    for i in range(n):
+        cost = cell_cost(short[:, :, np.newaxis, i], windows[..., i],
+                         weights, squared)
+        if lengths is not None:
+            cost = np.where(i < lengths[:, np.newaxis], cost, 0.0)
+        total += cost
+    return total
+
+
+def sliding_distance(a, b, weights, metric='sliding'):
+    """ Finds the best alignment of the shorter of two series in the other.
+
+    With the sliding metric, the distance is the smallest sum of the cell
+    distances, as in TrendLine.distance. With the euclidean metric, it is
+    the smallest euclidean distance of the aligned series, as in
+    array_trend_distance.
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    if len(a) == 0:
+        return 0.0
+    costs = alignment_costs(a[np.newaxis], b[np.newaxis], weights,
+                            metric == 'euclidean')
+    best = costs.min()
+    return float(np.sqrt(best) if metric == 'euclidean' else best)
+
+
+def sliding_distances(query, tensor, lengths, weights, metric='sliding'):
+    """ Computes the sliding_distance from a query to many references.
+
+    The references are given as a padded reference x time window x feature
+    tensor and their lengths, like the tensor of a TrendModel. The query is
+    slid along all references at least as long as it at once, and then all
+    shorter references are slid along the query at once.
+    """
+    n = len(query)
+    squared = metric == 'euclidean'
+    distances = np.zeros(len(tensor))
+    longer = lengths >= n
+    if n > 0 and longer.any():
+        costs = alignment_costs(query[np.newaxis], tensor[longer], weights,
+                                squared)
+        inside = np.arange(costs.shape[1]) <= (lengths[longer] -
+                                               n)[:, np.newaxis]
+        distances[longer] = np.where(inside, costs, np.inf).min(axis=1)
+    shorter = (lengths < n) & (lengths > 0)
+    if shorter.any():
+        m = lengths[shorter]
+        # Pad the query so that every reference has an offset per window
+        padded = np.full((1, n + m.max() - 1, query.shape[1]), np.nan)
+        padded[0, :n] = query
+        costs = alignment_costs(tensor[shorter, :m.max()], padded, weights,
+                                squared, m)
+        inside = np.arange(n) <= (n - m)[:, np.newaxis]
+        distances[shorter] = np.where(inside, costs, np.inf).min(axis=1)
+    return np.sqrt(distances) if squared else distances
@@ -0,0 +1,341 @@
+import asyncio
+import json
+import sys
+import time
+from joblib import Parallel, delayed, effective_n_jobs
+import numpy as np
+from .model import FEATURES, TREND_PREEMT, feature_scales, nearest_chunk
+from .twitter import BagOfWords, NameMatcher, TOKENIZERS, lexical_density, \
+    parse_tweet
+
+# What is totalled for each tweet of a window, in the order add gives them
+TOTALS = ('count', 'avg_followers', 'avg_statuses', 'retweets', 'lengths',
+          'lexical_density')
+COUNT = FEATURES.index('count')
+DELTA = FEATURES.index('delta')
+DELTA_DELTA = FEATURES.index('delta_delta')
+
+
+class TrendPredictor:
+    """ Predicts which topics of a stream of tweets are going to trend.
+
+    Tweets are added in the order they were posted, and the tweets of every
+    candidate topic are totalled for the current time window. Once a tweet
+    of a later window arrives the window is closed. Every candidate then gets
+    the features of the window, worked out as in
+    TrendLine.populate_from_table, and the last history windows of each are
+    normalized as in TrendModel.normalize and matched with their nearest
+    trend in the model. Candidates whose nearest trend trends are predicted
+    to trend.
+
+    The candidates are the given trend names, which tweets match as in
+    TrendLine.match_text, or otherwise every word of the tweets that is not
+    a stopword, read as BagOfWords reads the words the negative trends are
+    named after. At most capacity candidates are kept. Whenever a window
+    closes, those with the most tweets over the history are kept and the
+    others dropped, as are candidates without any tweets in the history.
+
+    Only candidates with tweets in the window just closed are matched again,
+    the budget most active of them, and each only against the C trends the
+    index of the model gives it (see TrendIndex). Closing a window thus
+    computes at most budget * C DTW distances, however many candidates are
+    kept, however much they churn and however many trends the model has.
+    Without a number of candidates C, every trend of the model is searched.
+    """
+
+    def __init__(self, model, names=None, stopwords=frozenset(),
+                 capacity=1000, history=TREND_PREEMT, min_windows=1,
+                 window=None, tokenizer='regex', window_size=120,
+                 candidates=50, budget=100, n_jobs=1):
+        """ Constructor for TrendPredictor before any tweets.
+
+        The model is the TrendModel to match candidates with and window an
+        optional SakoeChiba or Itakura DTW constraint. Candidates are only
+        matched once they have been kept for min_windows windows, and at
+        most budget of them on each close. With a number of candidates C,
+        the index of the model is built if it has none. The candidates are
+        matched in chunks by n_jobs joblib workers, as in
+        TrendModel.nearest_trends. Lexical density is worked out with the
+        regex tokenizer by default, which is much faster than NLTK (see
+        TOKENIZERS).
+        """
+        self.model = model
+        self.names = None if names is None else list(names)
+        self.matcher = None if names is None else NameMatcher(self.names)
+        self.stopwords = stopwords
+        self.capacity = capacity if names is None else len(self.names)
+        self.history = history
+        self.min_windows = min_windows
+        self.window = window
+        self.tokenizer = TOKENIZERS[tokenizer]
+        self.window_size = window_size
+        self.labels = model.labels()
+        self.envelopes = model.envelopes(window)
+        self.candidates = candidates
+        self.budget = budget
+        self.index = None
+        if candidates is not None:
+            self.index = model.build_index() if model.index is None \
+                else model.index
+        self.n_jobs = n_jobs
+        self.columns = [FEATURES.index(total) for total in TOTALS]
+        # Each candidate has a slot, with the features of its last history
+        # windows in a ring that is shared by all slots
+        self.cells = np.zeros((self.capacity, history, len(FEATURES)))
+        self.ages = np.zeros(self.capacity, dtype=np.int64)
+        self.slots = {}
+        self.free = list(range(self.capacity - 1, -1, -1))
+        self.position = 0
+        self.window_start = None
+        self.totals = {}
+        self.late = 0
+        self.closed = 0
+        self.slowest = 0.0
+
+    def closes(self, ts):
+        """ Returns whether a tweet posted at ts closes the current window. """
+        return self.window_start is not None and \
+            ts >= self.window_start + self.window_size
+
+    def add(self, ts, followers, statuses, text, retweeted):
+        """ Adds a tweet, as given by parse_tweet, to the current window.
+
+        Tweets posted before the current window are too late and only
+        counted in late.
+
+        :return: The predictions of the windows the tweet closes
+        """
+        predictions = self.advance(ts)
+        if ts < self.window_start:
+            self.late += 1
+            return predictions
+        words = text.split()
+        if self.matcher is None:
+            candidates = []
+            for word in dict.fromkeys(word.lower() for word in words):
+                if word in self.stopwords:
+                    continue
+                elif BagOfWords.word_re.match(word) is None:
+                    continue
+                else:
+                    candidates.append(word)
+        else:
+            candidates = [self.names[i] for i in self.matcher.matches(words)]
+        if len(candidates) == 0:
+            return predictions
+        values = np.array([1, followers, statuses, retweeted, len(text),
+                           lexical_density(self.tokenizer(text))],
+                          dtype=np.float64)
+        for candidate in candidates:
+            totals = self.totals.get(candidate)
+            if totals is None:
+                self.totals[candidate] = values.copy()
+            else:
+                totals += values
+        return predictions
+
+    def advance(self, ts):
+        """ Closes every window that ends at or before ts.
+
+        :return: The predictions of the windows closed
+        """
+        if self.window_start is None:
+            self.window_start = ts - ts % self.window_size
+        predictions = []
+        while self.closes(ts):
+            predictions.extend(self.close())
+        return predictions
+
+    def flush(self):
+        """ Closes the current window, at the end of the stream. """
+        if self.window_start is None:
+            return []
+        return self.close()
+
+    def close(self):
+        """ Closes the current window and matches the candidates.
+
+        :return: A list with, for every candidate predicted to trend, the
+                 start of the window, the name of the candidate, the DTW
+                 distance to its nearest trend and the name of that trend
+        """
+        started = time.perf_counter()
+        self.keep()
+        totals = np.zeros((self.capacity, len(TOTALS)))
+        for candidate, slot in self.slots.items():
+            if candidate in self.totals:
+                totals[slot] = self.totals[candidate]
+        cells = np.zeros((self.capacity, len(FEATURES)))
+        cells[:, self.columns] = totals
+        count = totals[:, 0]
+        seen = count > 0
+        cells[np.ix_(seen, self.columns[1:])] /= count[seen, np.newaxis]
+        previous = self.cells[:, self.position - 1]
+        cells[:, DELTA] = np.where(self.ages > 0,
+                                   count - previous[:, COUNT], 0)
+        cells[:, DELTA_DELTA] = np.where(self.ages > 1,
+                                         cells[:, DELTA] - previous[:, DELTA],
+                                         0)
+        self.cells[:, self.position] = cells
+        self.position = (self.position + 1) % self.history
+        self.ages[list(self.slots.values())] += 1
+
+        predictions = self.predict()
+        self.window_start += self.window_size
+        self.totals = {}
+        self.closed += 1
+        self.slowest = max(self.slowest, time.perf_counter() - started)
+        return predictions
+
+    def keep(self):
+        """ Drops and adds candidates before the current window is closed.
+
+        The activity of a candidate is its number of tweets in the current
+        window and in the windows of the history that are kept. The capacity
+        most active candidates are kept, the earlier ones on ties.
+        """
+        names = list(self.slots)
+        names.extend(candidate for candidate in self.totals
+                     if candidate not in self.slots)
+        # The window at position drops out of the ring on this close
+        counts = self.cells[:, :, COUNT].sum(axis=1) - \
+            self.cells[:, self.position, COUNT]
+        activity = np.array([self.totals[name][0] if name in self.totals
+                             else 0.0 for name in names])
+        activity[:len(self.slots)] += counts[list(self.slots.values())]
+        order = np.argsort(-activity, kind='stable')[:self.capacity]
+        kept = [names[k] for k in order if activity[k] > 0]
+        staying = set(kept)
+        for name in names[:len(self.slots)]:
+            if name not in staying:
+                slot = self.slots.pop(name)
+                self.cells[slot] = 0.0
+                self.ages[slot] = 0
+                self.free.append(slot)
+        for name in kept:
+            if name not in self.slots:
+                self.slots[name] = self.free.pop()
+
+    def predict(self):
+        """ Matches the candidates with their nearest trends in the model.
+
+        The candidates matched are those with tweets in the current window
+        that have been kept for min_windows windows, at most budget of them,
+        the ones with the most tweets in the window first and in the order
+        they were kept on ties.
+        """
+        ready = [(name, slot) for name, slot in self.slots.items()
+                 if name in self.totals and
+                 self.ages[slot] >= self.min_windows]
+        if len(ready) == 0:
+            return []
+        activity = np.array([self.totals[name][0] for name, _ in ready])
+        order = np.argsort(-activity, kind='stable')[:self.budget]
+        ready = [ready[k] for k in order]
+        slots = np.array([slot for _, slot in ready])
+        lengths = np.minimum(self.ages[slots], self.history)
+        # Oldest window first, as the trends of the model are
+        ring = (self.position + np.arange(self.history)) % self.history
+        cells = self.cells[slots][:, ring]
+        queries = np.full(cells.shape, np.nan)
+        for k, n in enumerate(lengths):
+            queries[k, :n] = cells[k, self.history - n:]
+        queries /= feature_scales(queries, lengths)[:, np.newaxis]
+        chosen = None
+        if self.candidates is not None:
+            chosen = self.index.candidates(queries, lengths, self.candidates)
+        chunks = np.array_split(np.arange(len(ready)),
+                                4 * effective_n_jobs(self.n_jobs))
+        results = Parallel(n_jobs=self.n_jobs)(delayed(nearest_chunk)(
+            chunk[0], chunk[-1] + 1, queries, lengths, self.model.tensor,
+            self.model.lengths, self.model.weights, self.window,
+            self.envelopes, candidates=chosen)
+            for chunk in chunks if len(chunk) > 0)
+        matches = np.concatenate([matches for matches, _, _ in results])
+        distances = np.concatenate([distances for _, distances, _ in results])
+        return [{'window': self.window_start, 'name': name,
+                 'distance': float(distance),
+                 'match': self.model.trends[match].name}
+                for (name, _), match, distance in
+                zip(ready, matches.tolist(), distances.tolist())
+                if self.labels[match]]
+
+
+async def stdin_lines():
+    """ Yields the lines of standard input as they arrive.
+
+    Standard input redirected from a file can not be read asynchronously,
+    so it is replayed like file_lines does.
+    """
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    try:
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    except ValueError:
+        for line in sys.stdin:
+            yield line
+        return
+    async for line in reader:
+        yield line.decode('utf-8')
+
+
+async def socket_lines(host, port):
+    """ Yields the lines sent by a server until it closes the connection. """
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        async for line in reader:
+            yield line.decode('utf-8')
+    finally:
+        writer.close()
+
+
+async def file_lines(path, follow=False, interval=1.0):
+    """ Yields the lines of a file, and with follow those added to it later.
+
+    Without follow this replays the file and stops at its end. With follow,
+    the file is checked for new lines every interval seconds, like tail -f,
+    and a line is only yielded once all of it has been written.
+    """
+    with open(path, encoding='utf-8') as f:
+        pending = ''
+        while True:
+            line = f.readline()
+            if len(line) > 0:
+                pending += line
+                if pending.endswith('\n'):
+                    yield pending
+                    pending = ''
+            elif follow:
+                await asyncio.sleep(interval)
+            else:
+                break
+        if len(pending) > 0:
+            yield pending
+
+
+def print_prediction(prediction):
+    """ Prints a prediction of a TrendPredictor as a line of JSON. """
+    print(json.dumps(prediction, ensure_ascii=False), flush=True)
+
+
+async def predict_stream(predictor, lines, emit=print_prediction):
+    """ Feeds a stream of tweets to a TrendPredictor and emits predictions.
+
+    Lines is an asynchronous iterable of tweets, one JSON object per line,
+    such as stdin_lines, socket_lines or file_lines. Windows are closed in
+    the default executor, so that the event loop is not held up while the
+    candidates are matched. Once the stream ends, the last window is closed.
+    """
+    loop = asyncio.get_running_loop()
+    async for line in lines:
+        if len(line.strip()) == 0:
+            continue
+        tweet = parse_tweet(line)
+        if predictor.closes(tweet[0]):
+            for prediction in await loop.run_in_executor(
+                    None, predictor.advance, tweet[0]):
+                emit(prediction)
+        predictor.add(*tweet)
+    for prediction in predictor.flush():
+        emit(prediction)
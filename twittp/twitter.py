@@ -1,8 +1,24 @@
+from array import array
+from bisect import bisect_right
 import calendar
 from collections import Counter
 import datetime as dt
+import heapq
+from itertools import accumulate
+from operator import itemgetter
+import random
 import re
 import json
+import os
+import shutil
+import tempfile
+from joblib import Parallel, delayed, effective_n_jobs
+import nltk
+import numpy as np
+from .columns import Bitmap, ColumnWriter, chunks_of
+from .shards import byte_shards, read_lines
+
+CHUNK = 1 << 16  # Tweets buffered, or values copied, between store writes
 
 
 class TwitterTrend:
@@ -13,9 +29,13 @@ class TwitterTrend:
     on the other hand is intended to communicate change in a Trend over time
     based on some properties of the Tweets as they were in a time window. Use
     this to model the output from the Twitter API's trending endpoint.
+
+    The windows the trend was trending in are kept as runs of consecutive
+    windows, [starts[k], ends[k]) in seconds, in order and never touching.
     """
 
-    def __init__(self, name, timestamps=None, window_size=120):
+    def __init__(self, name, timestamps=None, window_size=120, starts=None,
+                 ends=None):
         """ Constructor for TwitterTrend with or without timestamps.
 
         If no timestamps are provided, it is assumed that they will be filled
@@ -23,30 +43,58 @@ class TwitterTrend:
         should be the name of the trend as in the JSON file retrieved from the
         Twitter API. The window_size should almost never be changed, but it is
         the number of seconds between trend windows, aka, it represents how
-        granular our trends are.
+        granular our trends are. The windows may also be given as runs with
+        starts and ends instead of timestamps.
         """
         self.name = name
-        self.timestamps = [] if timestamps is None else timestamps
         self.window_size = window_size
+        if starts is None:
+            starts, ends = TwitterTrend.runs_of(
+                [] if timestamps is None else timestamps, window_size)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+
+    @property
+    def timestamps(self):
+        """ The start of every window the trend was trending in. """
+        return [ts for start, end in zip(self.starts.tolist(),
+                                         self.ends.tolist())
+                for ts in range(start, end, self.window_size)]
+
+    @staticmethod
+    def runs_of(timestamps, window_size=120):
+        """ Returns the starts and ends of the runs of sorted timestamps. """
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        breaks = np.flatnonzero(np.diff(timestamps) != window_size) + 1
+        starts = timestamps[np.concatenate(([0], breaks))] \
+            if len(timestamps) > 0 else timestamps
+        ends = timestamps[np.concatenate((breaks - 1,
+                                          [len(timestamps) - 1]))] \
+            + window_size if len(timestamps) > 0 else timestamps
+        return starts, ends
 
     @staticmethod
     def from_file(json_file):
-        """ Read a trends from a file using the from_twitter_json method. """
-        lines = []
+        """ Read a trends from a file using the from_twitter_json method.
+
+        The file is read one line at a time rather than all at once.
+        """
         with open(json_file, encoding='utf-8') as f:
-            for line in f:
-                lines.append(line)
-        return TwitterTrend.from_json_strings(lines)
+            return TwitterTrend.from_json_strings(f)
 
     @staticmethod
     def from_json_strings(json_strings):
         """ Constructs a list of TwitterTrends from a list of json strings.
 
-        This json_strings argument is expected to be a list of JSON strings,
-        each of which is the return value from the Twitter API's trends
-        endpoint at a particular time.
+        This json_strings argument is expected to be a list, or any iterable,
+        of JSON strings, each of which is the return value from the Twitter
+        API's trends endpoint at a particular time. The topics of each are
+        taken to be trending in every window from the window after the last
+        one filled up to the time of the response, and runs of windows are
+        extended as they go, so the memory used grows with the number of
+        runs rather than of windows.
         """
-        trends_timestamps = {}
+        trends_runs = {}
         last_ts = 0
         for json_s in json_strings:
             json_obj = json.loads(json_s)
@@ -64,22 +112,54 @@ class TwitterTrend:
             if last_ts == 0:
                 last_ts = ts - (ts % 120)
 
-            while ts > last_ts:
-                for topic in json_obj['trends']:
-                    if trends_timestamps.get(topic['name']) is None:
-                        trends_timestamps[topic['name']] = []
-                        trends_timestamps[topic['name']].append(last_ts)
-                    else:
-                        trends_timestamps[topic['name']].append(last_ts)
-                last_ts += 120
+            if ts <= last_ts:
+                continue
+            # The windows from last_ts up to the first at or after ts
+            end_ts = last_ts + 120 * -((last_ts - ts) // 120)
+            for topic in json_obj['trends']:
+                runs = trends_runs.setdefault(topic['name'], [])
+                if len(runs) > 0 and runs[-1][1] == last_ts:
+                    runs[-1][1] = end_ts
+                else:
+                    runs.append([last_ts, end_ts])
+            last_ts = end_ts
 
         trends = []
-        for trend, timestamps in trends_timestamps.items():
-            twitter_trend = TwitterTrend(trend, timestamps=timestamps)
+        for trend, runs in trends_runs.items():
+            runs = np.array(runs, dtype=np.int64).reshape(-1, 2)
+            twitter_trend = TwitterTrend(trend, starts=runs[:, 0],
+                                         ends=runs[:, 1])
             trends.append(twitter_trend)
 
         return trends
 
+    @staticmethod
+    def longest_runs(twitter_trends, window_size=120):
+        """ Finds the longest run of windows of every trend at once.
+
+        Ties go to the earliest run. A trend without any windows has a run
+        of length 0 that starts at None.
+
+        :return: The list of the starts of the runs and the array of their
+                 lengths in windows
+        """
+        counts = np.array([len(trend.starts) for trend in twitter_trends],
+                          dtype=np.int64)
+        if counts.sum() == 0:
+            return [None] * len(twitter_trends), np.zeros(len(counts),
+                                                          dtype=np.int64)
+        topics = np.repeat(np.arange(len(counts)), counts)
+        starts = np.concatenate([trend.starts for trend in twitter_trends])
+        ends = np.concatenate([trend.ends for trend in twitter_trends])
+        windows = (ends - starts) // window_size
+        order = np.lexsort((starts, -windows, topics))
+        first = order[np.minimum(np.searchsorted(topics[order],
+                                                 np.arange(len(counts))),
+                                 len(order) - 1)]
+        lengths = np.where(counts > 0, windows[first], 0)
+        return [int(start) if count > 0 else None for start, count in
+                zip(starts[first], counts)], lengths
+
 
 class BagOfWords(Counter):
     """ Represents a bag-of-words model of Tweets.
@@ -92,36 +172,90 @@ class BagOfWords(Counter):
     """
     word_re = re.compile("#?\w\w+\Z")
 
-    def random_trend_names(self, positive_trends, n=1):
-        """ Creates n unique topics that don't match any positive topics. """
-        total = 0
-        words = []
-        weights = []
-        for word, weight in self.items():
-            total += weight
-            weights.append(total)
-            words.append(word)
+    def add(self, word, count=1):
+        """ Counts a word count more times. """
+        self[word] += count
+
+    def merge(self, other):
+        """ Adds the counts of another model of the same kind to these. """
+        self.update(other)
+
+    def add_words(self, words, stopwords=set()):
+        """ Counts the words of a tweet, as str.split gives them, that are
+        not stopwords.
+        """
+        for word in words:
+            word = word.lower()
+            if word in stopwords:
+                continue
+            elif BagOfWords.word_re.match(word) is None:
+                continue
+            else:
+                self.add(word)
+
+    @staticmethod
+    def empty(capacity=None):
+        """ Returns an empty model, with at most capacity words if given. """
+        return BagOfWords() if capacity is None else HeavyHitters(capacity)
 
-        negative_names = set()
+    def random_trend_names(self, positive_trends, n=1, weighted=False,
+                           rng=random):
+        """ Creates n unique topics that don't match any positive topics.
 
-        for i in range(n):
-            if len(negative_names) != i:
-                print("Problem making random names")
+        The positive trends may be given as names or as anything with a name,
+        and they are compared in lower case, as the words of the model are.
+        By default the names are the n most common words that are not
+        positive, most common first and in order of first appearance among
+        equally common words. With weighted, they are instead drawn at random
+        in proportion to how common they are, using rng. The counts of the
+        model are left as they are.
+        """
+        positive_names = {getattr(trend, 'name', trend).lower()
+                          for trend in positive_trends}
+        if weighted:
+            return self.sampled_names(positive_names, n, rng)
+        return self.top_names(positive_names, n)
 
-            new_trend = None
+    def top_names(self, excluded, n):
+        """ Returns the n most common words that are not excluded.
 
-            while True:
-                new_trend, count = self.most_common(1)[0]
-                self[new_trend] = 0
+        This is one partial sort of the model for the n + len(excluded) most
+        common words, which can not all be excluded.
+        """
+        top = heapq.nlargest(n + len(excluded), self.items(),
+                             key=itemgetter(1))
+        names = [word for word, count in top
+                 if count > 0 and word not in excluded][:n]
+        if len(names) < n:
+            raise ValueError('Only {} words can be trend names, not {}'.format(
+                len(names), n))
+        return names
 
-                if new_trend not in positive_trends and new_trend not in negative_names:
-                    break
+    def sampled_names(self, excluded, n, rng=random):
+        """ Draws n distinct words that are not excluded, weighted by count.
 
-            negative_names |= set([new_trend])
-        return list(negative_names)
+        Each draw bisects the cumulative counts of the model, and draws of a
+        word that is excluded or already drawn are made again.
+        """
+        words = list(self)
+        cumulative = list(accumulate(self.values()))
+        available = sum(1 for word, count in self.items()
+                        if count > 0 and word not in excluded)
+        if available < n:
+            raise ValueError('Only {} words can be trend names, not {}'.format(
+                available, n))
+        names = []
+        chosen = set()
+        while len(names) < n:
+            draw = rng.random() * cumulative[-1]
+            word = words[bisect_right(cumulative, draw)]
+            if word not in excluded and word not in chosen:
+                names.append(word)
+                chosen.add(word)
+        return names
 
     @staticmethod
-    def from_file(json_file, stopwords=set()):
+    def from_file(json_file, stopwords=set(), n_jobs=1, capacity=None):
         """ Takes a file of Tweets and a stopwords set and create a word model.
 
         The json_file should be a string path to the file containing one tweet
@@ -130,22 +264,569 @@ class BagOfWords(Counter):
         so other fields can be dropped for bag of words model creation. The
         stopwords argument is a set containing the words to ignore when
         constructing the model.
+
+        With n_jobs other than 1, the file is split into that many shards of
+        whole lines that are counted by joblib workers. The counts of the
+        shards are merged in file order, so the words are in the same order
+        of first appearance as when the file is read by one process. The file
+        may also be a store of tweets (see TweetTable.save). With a capacity,
+        only that many words of the file are kept track of (see HeavyHitters).
+        A store already holds its whole vocabulary, so its words are counted
+        exactly whatever the capacity.
+        """
+        if TweetTable.is_store(json_file):
+            return TweetTable.load(json_file).bag_of_words(stopwords)
+        shards = byte_shards(json_file, effective_n_jobs(n_jobs))
+        if len(shards) <= 1:
+            return BagOfWords.from_shard(json_file, 0, None, stopwords,
+                                         capacity)
+        bag_of_words = BagOfWords.empty(capacity)
+        for partial in Parallel(n_jobs=n_jobs)(
+                delayed(BagOfWords.from_shard)(json_file, start, end,
+                                               stopwords, capacity)
+                for start, end in shards):
+            bag_of_words.merge(partial)
+        return bag_of_words
+
+    @staticmethod
+    def from_shard(json_file, start, end, stopwords=set(), capacity=None):
+        """ Creates a word model from the tweets in a byte range of a file. """
+        bag_of_words = BagOfWords.empty(capacity)
+        for line in read_lines(json_file, start, end):
+            tweet = json.loads(line)
+            bag_of_words.add_words(tweet['text'].split(), stopwords)
+        return bag_of_words
+
+
+class HeavyHitters(BagOfWords):
+    """ A bag-of-words model that keeps track of at most capacity words.
+
+    This is the Space-Saving algorithm of Metwally et al.: once capacity words
+    are counted, a new word takes the place of the least common one and
+    inherits its count, which is then the largest possible error of the new
+    count. Counts are never too low, and too high by at most the total of all
+    counts over capacity, so every word more common than that is kept. Those
+    are the ones negative trend names are taken from.
+
+    Models of separate files or shards can be merged, as in Agarwal et al.,
+    "Mergeable summaries", with the same bound on the error.
+    """
+
+    def __init__(self, capacity):
+        """ Constructor for HeavyHitters with no words counted. """
+        super().__init__()
+        self.capacity = capacity
+        self.errors = {}
+        self.total = 0
+        # One (count, word) per word, with counts that may be out of date
+        self.heap = []
+
+    def __reduce__(self):
+        return self.__class__, (self.capacity,), self.__dict__, None, \
+            iter(self.items())
+
+    def add(self, word, count=1):
+        """ Counts a word count more times. """
+        self.total += count
+        if word in self:
+            self[word] += count
+            return
+        error = 0
+        if len(self) >= self.capacity:
+            error = self.minimum()
+            _, evicted = heapq.heappop(self.heap)
+            del self[evicted]
+            del self.errors[evicted]
+        self[word] = error + count
+        self.errors[word] = error
+        heapq.heappush(self.heap, (error + count, word))
+
+    def minimum(self):
+        """ Returns the smallest count, or 0 if fewer than capacity words
+        are counted, which is then the count a word not counted may have.
+        """
+        if len(self) < self.capacity:
+            return 0
+        while self.heap[0][0] != self[self.heap[0][1]]:
+            _, word = self.heap[0]
+            heapq.heapreplace(self.heap, (self[word], word))
+        return self.heap[0][0]
+
+    def error(self, word):
+        """ Returns how much higher the count of a word may be than it is. """
+        return self.errors.get(word, self.minimum())
+
+    def merge(self, other):
+        """ Adds the counts of another HeavyHitters to these.
+
+        Words counted by only one of the two are taken to have the smallest
+        count of the other, and the capacity most common words are kept.
         """
+        floor = self.minimum()
+        other_floor = other.minimum()
+        counts = {}
+        errors = {}
+        for word in list(self) + [word for word in other if word not in self]:
+            counts[word] = self.get(word, floor) + other.get(word, other_floor)
+            errors[word] = self.errors.get(word, floor) + \
+                other.errors.get(word, other_floor)
+        kept = heapq.nlargest(self.capacity, counts.items(), key=itemgetter(1))
+        self.clear()
+        self.errors = {}
+        for word, count in kept:
+            self[word] = count
+            self.errors[word] = errors[word]
+        self.heap = [(count, word) for word, count in kept]
+        heapq.heapify(self.heap)
+        self.total += other.total
+
+
+# Approximates the tokens of nltk.tokenize.word_tokenize: contractions are
+# split the Penn Treebank way, numbers, hyphenated and dotted words are kept
+# whole, and any other symbol is a token of its own
+TOKEN_RE = re.compile(r"\w+?(?=n't\b)|n't\b|'(?i:s|m|d|ll|re|ve)\b|\.\.\.|"
+                      r"-?\d+(?:[.,:]\d+)*\w*|//\S+|\w+(?:[-./]\w+)*|[^\w\s]")
+
+
+def nltk_tokenize(text):
+    """ Splits text into tokens with NLTK. """
+    return nltk.tokenize.word_tokenize(text)
+
+
+def regex_tokenize(text):
+    """ Splits text into tokens with TOKEN_RE, which is much faster. """
+    return TOKEN_RE.findall(text)
+
+
+# The tokenizers a TweetTable can use, by name
+TOKENIZERS = {'nltk': nltk_tokenize, 'regex': regex_tokenize}
+
+
+def lexical_density(tokens):
+    """ Returns the fraction of tokens that are distinct. """
+    return 0 if len(tokens) == 0 else len(set(tokens)) / len(tokens)
+
+
+def compare_tokenizers(texts, tokenizer='regex', reference='nltk'):
+    """ Measures how closely a tokenizer follows another on a sample of text.
+
+    :return: The fraction of texts given exactly the same tokens, and the
+             mean and largest absolute difference in lexical density
+    """
+    same = 0
+    differences = []
+    for text in texts:
+        tokens = TOKENIZERS[tokenizer](text)
+        reference_tokens = TOKENIZERS[reference](text)
+        same += tokens == reference_tokens
+        differences.append(abs(lexical_density(tokens) -
+                               lexical_density(reference_tokens)))
+    if len(differences) == 0:
+        return 1.0, 0.0, 0.0
+    return same / len(differences), sum(differences) / len(differences), \
+        max(differences)
+
+
+EPOCH = dt.datetime(1970, 1, 1, tzinfo=dt.timezone(dt.timedelta(0)))
+
+
+def parse_tweet(line):
+    """ Reads the fields twittp uses from a tweet, one JSON object.
+
+    :return: The UTC timestamp of the tweet in seconds, the followers and
+             statuses of its user, its text and whether it was retweeted
+    """
+    tweet = json.loads(line)
+    created = dt.datetime.strptime(tweet['created_at'],
+                                   "%a %b %d %H:%M:%S %z %Y")
+    return ((created - EPOCH) // dt.timedelta(seconds=1),
+            tweet['user_followers'], tweet['user_statuses'], tweet['text'],
+            bool(tweet['retweeted']))
+
+
+class TweetTable:
+    """ The fields of a file of tweets that a model is built from, as arrays.
+
+    Every tweet is decoded from JSON once, into the time it was posted in
+    seconds since the epoch, the follower and status counts of its user, the
+    length of its text, whether it was retweeted and the ids of its words in
+    the vocabulary, where a word is anything flanked by whitespace. Word ids
+    are given in order of first appearance.
+
+    The tweets that match a trend also need their tokens, by NLTK or by the
+    faster regex_tokenize (see TOKENIZERS). These are either worked out from
+    the text when needed, which is then kept as UTF-8 bytes, or done for
+    every tweet up front and kept as ids in a vocabulary of tokens, as in a
+    store written by save.
+    """
+
+    # The columns of a TweetTable, as kept in a store
+    COLUMNS = ('epochs', 'followers', 'statuses', 'lengths', 'retweeted',
+               'word_offsets', 'word_ids', 'text', 'text_offsets',
+               'token_offsets', 'token_ids')
+    # The type of each column in a store, where retweeted is a bitmap
+    DTYPES = {'epochs': np.int64, 'followers': np.int64,
+              'statuses': np.int64, 'lengths': np.int64, 'retweeted': bool,
+              'word_offsets': np.int64, 'word_ids': np.int32,
+              'text': np.uint8, 'text_offsets': np.int64,
+              'token_offsets': np.int64, 'token_ids': np.int32}
+
+    def __init__(self, epochs, followers, statuses, lengths, retweeted,
+                 word_offsets, word_ids, vocabulary, text=None,
+                 text_offsets=None, token_offsets=None, token_ids=None,
+                 token_vocabulary=None, tokenizer='nltk'):
+        """ Constructor for TweetTable from its arrays.
+
+        The words of tweet i are word_ids[word_offsets[i]:word_offsets[i + 1]]
+        and its text is text[text_offsets[i]:text_offsets[i + 1]], and the
+        same goes for its tokens. Either the text or the tokens may be None.
+        Tokenizer names the tokenizer the tokens are, or will be, made by.
+        """
+        self.epochs = epochs
+        self.followers = followers
+        self.statuses = statuses
+        self.lengths = lengths
+        self.retweeted = retweeted
+        self.word_offsets = word_offsets
+        self.word_ids = word_ids
+        self.vocabulary = vocabulary
+        self.text = text
+        self.text_offsets = text_offsets
+        self.token_offsets = token_offsets
+        self.token_ids = token_ids
+        self.token_vocabulary = token_vocabulary
+        self.tokenizer = tokenizer
+        # The temporary directory of a table read by from_file, if any
+        self.scratch = None
+        # The HeavyHitters of a table read by from_file with a capacity
+        self.sketch = None
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def __getstate__(self):
+        # The copies joblib hands to workers must not remove the directory
+        state = self.__dict__.copy()
+        state['scratch'] = None
+        return state
+
+    def words(self, i):
+        """ Returns the words of tweet i, as str.split gives them. """
+        ids = self.word_ids[self.word_offsets[i]:self.word_offsets[i + 1]]
+        return [self.vocabulary[k] for k in ids]
+
+    def text_of(self, i):
+        """ Returns the text of tweet i. """
+        return self.text[self.text_offsets[i]:
+                         self.text_offsets[i + 1]].tobytes().decode('utf-8')
+
+    def tokens(self, i):
+        """ Returns the tokens of tweet i. """
+        if self.token_ids is None:
+            return TOKENIZERS[self.tokenizer](self.text_of(i))
+        ids = self.token_ids[self.token_offsets[i]:self.token_offsets[i + 1]]
+        return [self.token_vocabulary[k] for k in ids]
+
+    def bag_of_words(self, stopwords=set()):
+        """ Creates the word model BagOfWords.from_file gives for the tweets.
+
+        The words are counted by vocabulary id, and since the ids are in order
+        of first appearance, the words of the model are in the same order too.
+        A table read from a file with a capacity instead gives the
+        HeavyHitters its words were counted into as they were read, leaving
+        out the stopwords it was read with (see from_file).
+        """
+        if self.sketch is not None:
+            return self.sketch
+        counts = np.bincount(self.word_ids, minlength=len(self.vocabulary))
         bag_of_words = BagOfWords()
-        with open(json_file, encoding='utf-8') as f:
-            for line in f:
-                tweet = json.loads(line)
-                words = tweet['text'].split()
-                for word in words:
-                    word = word.lower()
-                    if word in stopwords:
-                        continue
-                    elif BagOfWords.word_re.match(word) is None:
-                        continue
-                    else:
-                        bag_of_words[word] += 1
+        for word, count in zip(self.vocabulary, counts.tolist()):
+            word = word.lower()
+            if word in stopwords:
+                continue
+            elif BagOfWords.word_re.match(word) is None:
+                continue
+            else:
+                bag_of_words.add(word, count)
         return bag_of_words
 
+    def save(self, directory):
+        """ Writes the table to a store, a directory with one file a column.
+
+        The columns are .npy files and the vocabularies JSON. Whether tweets
+        were retweeted is kept as a bitmap, and ids as 32-bit integers.
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            if name == 'retweeted':
+                column = np.packbits(column)
+            elif name.endswith('_ids') and column is not None:
+                column = column.astype(np.int32)
+            if column is not None:
+                np.save(os.path.join(directory, name + '.npy'), column)
+        with open(os.path.join(directory, 'vocabulary.json'), 'w',
+                  encoding='utf-8') as f:
+            json.dump({'tweets': len(self), 'tokenizer': self.tokenizer,
+                       'words': self.vocabulary,
+                       'tokens': self.token_vocabulary}, f,
+                      ensure_ascii=False)
+
+    @staticmethod
+    def load(directory):
+        """ Opens a store written by save.
+
+        The columns are memory-mapped, so only those that are used are read,
+        and only when they are used. This goes for the bitmap of whether
+        tweets were retweeted too, which is read a byte at a time (see
+        Bitmap).
+        """
+        with open(os.path.join(directory, 'vocabulary.json'),
+                  encoding='utf-8') as f:
+            vocabularies = json.load(f)
+        columns = {}
+        for name in TweetTable.COLUMNS:
+            path = os.path.join(directory, name + '.npy')
+            columns[name] = np.load(path, mmap_mode='r') \
+                if os.path.exists(path) else None
+        columns['retweeted'] = Bitmap(columns['retweeted'],
+                                      vocabularies['tweets'])
+        return TweetTable(vocabulary=vocabularies['words'],
+                          token_vocabulary=vocabularies['tokens'],
+                          tokenizer=vocabularies.get('tokenizer', 'nltk'),
+                          **columns)
+
+    @staticmethod
+    def is_store(path):
+        """ Returns whether a path is a store rather than a file of tweets. """
+        return os.path.isfile(os.path.join(path, 'vocabulary.json'))
+
+    @staticmethod
+    def from_file(json_file, n_jobs=1, tokenize=False, tokenizer='nltk',
+                  directory=None, stopwords=set(), capacity=None):
+        """ Reads a file of tweets, one JSON object per line, or a store.
+
+        The tweets are written to a store in directory as they are read (see
+        StoreWriter), by default a temporary one that is removed with the
+        table, and the table is opened from it, so reading a file takes
+        about as much memory whatever its size. With n_jobs other than 1,
+        the file is split into that many shards of whole lines that joblib
+        workers write to stores of their own, which are then concatenated in
+        file order, which gives the same table as one process. With
+        tokenize, the tokens of every tweet are worked out by the named
+        tokenizer instead of keeping the text. A store keeps the tokenizer
+        it was written with.
+
+        With a capacity, the words of the tweets that are not stopwords are
+        also counted into a HeavyHitters of that capacity as they are read,
+        one for each shard, which are merged in file order as in
+        BagOfWords.from_file. This is what bag_of_words then gives, so the
+        word model never holds more than capacity words. A store already
+        holds its whole vocabulary, so its words are counted exactly.
+        """
+        if TweetTable.is_store(json_file):
+            return TweetTable.load(json_file)
+        scratch = None
+        if directory is None:
+            scratch = tempfile.TemporaryDirectory()
+            directory = scratch.name
+        shards = byte_shards(json_file, effective_n_jobs(n_jobs))
+        if len(shards) <= 1:
+            sketches = [TweetTable.write_shard(json_file, 0, None, directory,
+                                               tokenize, tokenizer,
+                                               stopwords, capacity)]
+        else:
+            parts = [os.path.join(directory, 'shard-{}'.format(k))
+                     for k in range(len(shards))]
+            sketches = Parallel(n_jobs=n_jobs)(delayed(
+                TweetTable.write_shard)(json_file, start, end, part, tokenize,
+                                        tokenizer, stopwords, capacity)
+                for (start, end), part in zip(shards, parts))
+            TweetTable.concatenate([TweetTable.load(part) for part in parts],
+                                   directory)
+            for part in parts:
+                shutil.rmtree(part)
+        table = TweetTable.load(directory)
+        table.scratch = scratch
+        if capacity is not None and len(sketches) == 1:
+            table.sketch = sketches[0]
+        elif capacity is not None:
+            table.sketch = BagOfWords.empty(capacity)
+            for sketch in sketches:
+                table.sketch.merge(sketch)
+        return table
+
+    @staticmethod
+    def write_shard(json_file, start, end, directory, tokenize=False,
+                    tokenizer='nltk', stopwords=set(), capacity=None):
+        """ Writes the tweets in a byte range of a file to a store.
+
+        :return: With a capacity, the HeavyHitters of the words of the
+                 tweets that are not stopwords, and otherwise None
+        """
+        writer = StoreWriter(directory, tokenize, tokenizer)
+        sketch = None if capacity is None else HeavyHitters(capacity)
+        for line in read_lines(json_file, start, end):
+            tweet = parse_tweet(line)
+            writer.add(*tweet)
+            if sketch is not None:
+                sketch.add_words(tweet[3].split(), stopwords)
+        writer.close()
+        return sketch
+
+    @staticmethod
+    def concatenate(tables, directory):
+        """ Writes TweetTables to a store as one, with the tweets of each in
+        order.
+
+        The columns are copied CHUNK values at a time, and the word and
+        token ids of each table are mapped to merged vocabularies, so the
+        ids of the store are in order of first appearance over all of them.
+        """
+        first = tables[0]
+        writer = StoreWriter(directory, first.token_ids is not None,
+                             first.tokenizer)
+        columns = writer.columns
+        tweets = 0
+        for table in tables:
+            for name in TweetTable.COLUMNS[:5]:
+                for chunk in chunks_of(getattr(table, name), CHUNK):
+                    columns[name].write(chunk)
+            for prefix, vocabulary, interned in (
+                    ('word', table.vocabulary, writer.words),
+                    ('token', table.token_vocabulary, writer.tokens),
+                    ('text', None, None)):
+                offsets = getattr(table, prefix + '_offsets')
+                if offsets is None:
+                    continue
+                values = prefix if prefix == 'text' else prefix + '_ids'
+                base = writer.sizes[prefix]
+                for chunk in chunks_of(offsets[1:], CHUNK):
+                    columns[prefix + '_offsets'].write(base + chunk)
+                writer.sizes[prefix] = base + int(offsets[-1])
+                mapping = None if interned is None else \
+                    interned.mapping(vocabulary)
+                for chunk in chunks_of(getattr(table, values), CHUNK):
+                    columns[values].write(chunk if mapping is None
+                                          else mapping[chunk])
+            tweets += len(table)
+        writer.tweets = tweets
+        writer.close()
+
+
+class StoreWriter:
+    """ Writes tweets to a store, as TweetTable.save lays it out, as they
+    come.
+
+    The fields of CHUNK tweets at a time are held in compact buffers and
+    then appended to the columns of the store (see ColumnWriter), so only
+    the vocabularies grow with the number of tweets. With tokenize, the
+    tokens of every tweet are kept rather than its text.
+    """
+
+    def __init__(self, directory, tokenize=False, tokenizer='nltk'):
+        """ Constructor for StoreWriter, which creates the store. """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.tokenize = tokenize
+        self.tokenizer = tokenizer
+        names = TweetTable.COLUMNS[:7] + (
+            ('token_offsets', 'token_ids') if tokenize
+            else ('text', 'text_offsets'))
+        self.columns = {name: ColumnWriter(
+            os.path.join(directory, name + '.npy'), TweetTable.DTYPES[name],
+            packed=name == 'retweeted') for name in names}
+        for name in names:
+            if name.endswith('_offsets'):
+                self.columns[name].write([0])
+        self.fields = tuple(array('q') for _ in range(4))
+        self.retweeted = array('b')
+        self.words = Interned()
+        self.tokens = Interned()
+        self.text = bytearray()
+        self.text_sizes = array('q')
+        # The number of values of each kind written so far
+        self.sizes = {'word': 0, 'token': 0, 'text': 0}
+        self.tweets = 0
+
+    def add(self, ts, followers, statuses, text, retweeted):
+        """ Adds a tweet, as given by parse_tweet. """
+        for field, value in zip(self.fields, (ts, followers, statuses,
+                                              len(text))):
+            field.append(value)
+        self.retweeted.append(retweeted)
+        self.words.add(text.split())
+        if self.tokenize:
+            self.tokens.add(TOKENIZERS[self.tokenizer](text))
+        else:
+            encoded = text.encode('utf-8')
+            self.text += encoded
+            self.text_sizes.append(len(encoded))
+        self.tweets += 1
+        if len(self.retweeted) >= CHUNK:
+            self.flush()
+
+    def flush(self):
+        """ Appends the buffered tweets to the columns. """
+        for name, field in zip(TweetTable.COLUMNS[:4], self.fields):
+            self.columns[name].write(field)
+            del field[:]
+        self.columns['retweeted'].write(self.retweeted)
+        del self.retweeted[:]
+        buffers = [('word', self.words.sizes, self.words.ids)]
+        if self.tokenize:
+            buffers.append(('token', self.tokens.sizes, self.tokens.ids))
+        else:
+            buffers.append(('text', self.text_sizes, self.text))
+        for prefix, sizes, values in buffers:
+            ends = self.sizes[prefix] + np.cumsum(np.array(sizes,
+                                                           dtype=np.int64))
+            self.columns[prefix + '_offsets'].write(ends)
+            self.columns[prefix if prefix == 'text' else prefix + '_ids'] \
+                .write(np.frombuffer(values, dtype=np.uint8)
+                       if prefix == 'text' else values)
+            self.sizes[prefix] += len(values)
+            del sizes[:]
+            del values[:]
+
+    def close(self):
+        """ Writes what is left and the vocabularies, and closes the store. """
+        self.flush()
+        for column in self.columns.values():
+            column.close()
+        with open(os.path.join(self.directory, 'vocabulary.json'), 'w',
+                  encoding='utf-8') as f:
+            json.dump({'tweets': self.tweets, 'tokenizer': self.tokenizer,
+                       'words': list(self.words),
+                       'tokens': list(self.tokens) if self.tokenize
+                       else None}, f, ensure_ascii=False)
+
+
+class Interned(dict):
+    """ This class gives ids to strings, in order of first appearance.
+
+    It maps each string to its id and keeps the ids of the lists of strings
+    added to it, one after another, with the size of each list, until they
+    are taken away.
+    """
+
+    def __init__(self):
+        """ Constructor for Interned with no strings. """
+        super().__init__()
+        self.ids = array('q')
+        self.sizes = array('q')
+
+    def add(self, strings):
+        """ Adds a list of strings. """
+        for string in strings:
+            self.ids.append(self.setdefault(string, len(self)))
+        self.sizes.append(len(strings))
+
+    def mapping(self, strings):
+        """ Returns the ids of strings, giving new ones to those not seen. """
+        return np.array([self.setdefault(string, len(self))
+                         for string in strings], dtype=np.int64)
+
 
 class Stopwords(set):
     """ This class represents a set of words to ignore constructing a model.
@@ -163,3 +844,29 @@ class Stopwords(set):
                 words = line.split(",")
                 sw.update(words)
         return sw
+
+
+class NameMatcher(dict):
+    """ This class finds which of a list of trend names a tweet matches.
+
+    It maps every word of every name to the set of indices of the names that
+    contain it. A tweet matches a name if any word of the name is one of the
+    words of the tweet, as in TrendLine.match_text, so the names a tweet
+    matches are found with one lookup per word of the tweet.
+    """
+
+    def __init__(self, names=()):
+        """ Constructor for NameMatcher over a list of names. """
+        super().__init__()
+        for i, name in enumerate(names):
+            for word in name.split():
+                self.setdefault(word, set()).add(i)
+
+    def matches(self, words):
+        """ Returns the set of indices of the names the words match. """
+        result = set()
+        for word in words:
+            indices = self.get(word)
+            if indices is not None:
+                result |= indices
+        return result